@@ -1,14 +1,80 @@
-from dash import Dash, dcc, html, Input, Output, State, dash_table
+from dash import Dash, dcc, html, Input, Output, State, dash_table, ctx, no_update, Patch
 import dash_bootstrap_components as dbc 
 import pandas as pd
-import plotly.express as px
-import io
-import base64
+import plotly.graph_objects as go
+import re
 from datetime import datetime
+from collections import OrderedDict
+import hashlib
+import threading
+import tempfile
+import time
+import uuid
 import os
+import cProfile
+from flask import request, jsonify, send_file, abort, g, Response, has_request_context
+import pipeline
+from pipeline import (
+    pa, feather, timed, record_stage, metrics_totals, METRICS_BUCKETS,
+    decode_contents, list_snapshots, snapshot_path, snapshot_metadata,
+    get_analytics, analytics_current, category_counts, summary_breakdown, BREAKDOWNS,
+    visa_thresholds, breach_forecast, forecast_buckets, FORECAST_DAYS,
+    CROSS_FILTERS, cross_filter_mask, summary_counts,
+    EXPORT_FORMATS, STREAM_FORMATS, FUZZY_THRESHOLD,
+    export_date, history_dates, load_history, history_analytics,
+)
+from jobs import (
+    UPLOAD_DIR, streamed_upload_path, remove_expired_files, read_upload_entry,
+    shared_put, shared_get, export_path, build_export,
+    submit_job, job_status, cancel_job, forget_job, wait_for_job, prebuild_export,
+    analytics_job, export_job, compare_job, history_job,
+)
 # Initialize Dash app
 app = Dash(__name__, external_stylesheets=[dbc.themes.FLATLY])
 app.title = "Excel Analysis Dashboard"
+# WSGI entry point for production servers: gunicorn app:server
+server = app.server
+
+# Rows per page served to the alert, at-risk and comparison tables
+TABLE_PAGE_SIZE = int(os.environ.get("TABLE_PAGE_SIZE", 25))
+
+# How often the browser asks for the progress of a background job
+JOB_POLL_MS = int(os.environ.get("JOB_POLL_MS", 500))
+
+# Formats offered by the download button (large uploads are streamed into
+# their export and can only be written as the STREAM_FORMATS)
+DOWNLOAD_FORMATS = [
+    {'label': "Excel workbook (one sheet per category)", 'value': 'xlsx'},
+    {'label': "CSV files (zip)", 'value': 'csv'},
+    {'label': "Parquet files (zip)", 'value': 'parquet'}
+]
+
+def job_panel(prefix):
+    """Progress bar, cancel button and stores for one background job"""
+    return html.Div([
+        html.Div([
+            dbc.Progress(id=f'{prefix}-progress', value=0, striped=True, animated=True,
+                         className="mb-1"),
+            html.Div([
+                html.Small(id=f'{prefix}-progress-label', className="text-muted me-3"),
+                dbc.Button("Cancel", id=f'btn-cancel-{prefix}', color="link", size="sm",
+                           className="p-0")
+            ])
+        ], id=f'{prefix}-job-panel', style={'display': 'none'}, className="mt-2"),
+        dcc.Interval(id=f'{prefix}-poll', interval=JOB_POLL_MS, disabled=True),
+        dcc.Store(id=f'{prefix}-job'),
+        dcc.Store(id=f'{prefix}-result'),
+        dcc.Store(id=f'{prefix}-cancel')
+    ])
+
+def breakdown_figure():
+    """Empty Live In / Live Out bar chart that breakdown updates are patched into"""
+    return go.Figure(
+        data=[go.Bar(name='Live In', x=[], y=[], marker_color='#28a745'),
+              go.Bar(name='Live Out', x=[], y=[], marker_color='#17a2b8')],
+        layout=go.Layout(barmode='group', title={'text': ""}, xaxis={'title': {'text': ""}},
+                         yaxis={'title': {'text': "Count"}}, legend={'title': {'text': "Live Type"}})
+    )
 
 # App Layout
 app.layout = dbc.Container([
@@ -36,15 +102,33 @@ app.layout = dbc.Container([
                             ),
                             className="mb-3"
                         ),
+                        html.Div([
+                            html.Small("Large file? ", className="text-muted"),
+                            html.A("Upload it directly", id='large-upload-link', href='#'),
+                            dcc.Store(id='streamed-upload')
+                        ], className="mb-2"),
+                        dcc.Dropdown(
+                            id='snapshot-select',
+                            placeholder="Or reopen a previous upload",
+                            className="mb-2"
+                        ),
+                        job_panel('analytics'),
                         html.Div(id='upload-status'),
+                        dbc.Select(
+                            id='download-format',
+                            options=DOWNLOAD_FORMATS,
+                            value='xlsx',
+                            className="mt-3"
+                        ),
                         dbc.Button(
                             "Download Processed File",
                             id="btn-download",
                             color="primary",
-                            className="w-100 mt-3",
-                            disabled=True
+                            className="w-100 mt-2",
+                            disabled=True,
+                            external_link=True
                         ),
-                        dcc.Download(id="download-dataframe-xlsx")
+                        dcc.Store(id='upload-token')
                     ])
                 ]),
                 html.Div(id='sheet-counts', className="mt-4")
@@ -54,6 +138,23 @@ app.layout = dbc.Container([
         # Tab 2: Analytics
         dbc.Tab(label="Analytics", children=[
             dbc.Card(dbc.CardBody([
+                # Cross-filters applied to every widget below
+                dbc.Row([
+                    dbc.Col(dcc.Dropdown(id='filter-nationality', multi=True, placeholder="Nationality"),
+                            width=12, md=3),
+                    dbc.Col(dcc.Dropdown(id='filter-visa-type', multi=True, placeholder="Visa type"),
+                            width=12, md=2),
+                    dbc.Col(dcc.Dropdown(id='filter-live-type', multi=True, placeholder="Live type"),
+                            width=12, md=2),
+                    dbc.Col(dcc.Dropdown(id='filter-category', multi=True, placeholder="Category"),
+                            width=12, md=2),
+                    dbc.Col(dcc.DatePickerRange(id='filter-landed', clearable=True,
+                                                start_date_placeholder_text="Landed from",
+                                                end_date_placeholder_text="to"),
+                            width=12, md=3),
+                    dcc.Store(id='analytics-filter')
+                ], className="mb-4 g-2"),
+
                 # Summary Statistics
                 dbc.Row([
                     dbc.Col(dbc.Card(dbc.CardBody([
@@ -72,15 +173,28 @@ app.layout = dbc.Container([
 
                 # Nationality Distribution Chart
                 dbc.Card([
-                    dbc.CardHeader("Nationality Distribution by Live In/Out"),
-                    dbc.CardBody(dcc.Graph(id="nationality-chart"))
+                    dbc.CardHeader([
+                        html.Span("Distribution by Live In/Out", className="me-3"),
+                        dbc.RadioItems(
+                            id='breakdown-by',
+                            options=[
+                                {'label': "Nationality", 'value': 'Nationality'},
+                                {'label': "Visa type", 'value': 'Type of Visa'},
+                                {'label': "Category", 'value': 'Category'}
+                            ],
+                            value='Nationality',
+                            inline=True,
+                            className="d-inline-block"
+                        )
+                    ]),
+                    dbc.CardBody(dcc.Graph(id="nationality-chart", figure=breakdown_figure()))
                 ], className="mb-4"),
 
                 # Visa Alerts and Risk Tables
                 dbc.Card([
                     dbc.CardHeader([
                         html.H5("Visa Alerts", className="mb-0 text-danger"),
-                        html.Small("Entry Visa: >3 days, Tourist Visa: >8 days", className="text-muted")
+                        html.Small(id='visa-alerts-rule', className="text-muted")
                     ]),
                     dbc.CardBody([
                         dash_table.DataTable(
@@ -99,8 +213,16 @@ app.layout = dbc.Container([
                                 'textAlign': 'left',
                                 'padding': '12px'
                             },
-                            sort_action='native'
-                        )
+                            page_action='custom',
+                            page_current=0,
+                            page_size=TABLE_PAGE_SIZE,
+                            sort_action='custom',
+                            sort_mode='multi',
+                            sort_by=[],
+                            filter_action='custom',
+                            filter_query=''
+                        ),
+                        html.Small(id='visa-alerts-total', className="text-muted")
                     ])
                 ], className="mb-4"),
                 
@@ -108,7 +230,7 @@ app.layout = dbc.Container([
                 dbc.Card([
                     dbc.CardHeader([
                         html.H5("At Risk Cases", className="mb-0 text-warning"),
-                        html.Small("Entry Visa: 2 days, Tourist Visa: 7 days", className="text-muted")
+                        html.Small(id='at-risk-rule', className="text-muted")
                     ]),
                     dbc.CardBody([
                         dash_table.DataTable(
@@ -127,8 +249,67 @@ app.layout = dbc.Container([
                                 'textAlign': 'left',
                                 'padding': '12px'
                             },
-                            sort_action='native'
-                        )
+                            page_action='custom',
+                            page_current=0,
+                            page_size=TABLE_PAGE_SIZE,
+                            sort_action='custom',
+                            sort_mode='multi',
+                            sort_by=[],
+                            filter_action='custom',
+                            filter_query=''
+                        ),
+                        html.Small(id='at-risk-total', className="text-muted")
+                    ])
+                ], className="mb-4"),
+                
+                # Days-until-breach forecast
+                dbc.Card([
+                    dbc.CardHeader([
+                        html.H5("Breach Forecast", className="mb-0 text-warning"),
+                        html.Small(f"Cases passing their alert threshold in the next {FORECAST_DAYS} days",
+                                   className="text-muted")
+                    ]),
+                    dbc.CardBody(id='breach-forecast')
+                ], className="mb-4"),
+                
+                # What moved since the previous upload
+                dbc.Card([
+                    dbc.CardHeader([
+                        html.H5("Changes Since Last Upload", className="mb-0 text-info"),
+                        html.Small(id='changes-title', className="text-muted")
+                    ]),
+                    dbc.CardBody([
+                        dash_table.DataTable(
+                            id='changes-table',
+                            columns=[{'name': col, 'id': col} for col in [
+                                'Housemaid Id', 'Housemaid Name', 'Change',
+                                'Category Before', 'Category After',
+                                'Visa Step Before', 'Visa Step After'
+                            ]],
+                            style_data_conditional=[
+                                {
+                                    'if': {'row_index': 'odd'},
+                                    'backgroundColor': 'rgba(248, 249, 250, 0.5)'
+                                }
+                            ],
+                            style_header={
+                                'backgroundColor': '#f8f9fa',
+                                'fontWeight': 'bold'
+                            },
+                            style_cell={
+                                'textAlign': 'left',
+                                'padding': '12px'
+                            },
+                            page_action='custom',
+                            page_current=0,
+                            page_size=TABLE_PAGE_SIZE,
+                            sort_action='custom',
+                            sort_mode='multi',
+                            sort_by=[],
+                            filter_action='custom',
+                            filter_query=''
+                        ),
+                        html.Small(id='changes-total', className="text-muted")
                     ])
                 ])
             ]))
@@ -150,6 +331,11 @@ app.layout = dbc.Container([
                                 className="border-dashed"
                             )
                         ),
+                        dcc.Dropdown(
+                            id='snapshot-file-1',
+                            placeholder="Or use a previous upload",
+                            className="mt-2"
+                        ),
                         html.Div(id='file1-status')
                     ], width=12, md=6),
                     dbc.Col([
@@ -164,13 +350,52 @@ app.layout = dbc.Container([
                                 className="border-dashed"
                             )
                         ),
+                        dcc.Dropdown(
+                            id='snapshot-file-2',
+                            placeholder="Or use a previous upload",
+                            className="mt-2"
+                        ),
                         html.Div(id='file2-status')
                     ], width=12, md=6),
                 ], className="mb-4"),
 
+                dbc.RadioItems(
+                    id='comparison-mode',
+                    options=[
+                        {'label': "Same name and visa step", 'value': 'matches'},
+                        {'label': "Only in first file", 'value': 'only_file_1'},
+                        {'label': "Only in second file", 'value': 'only_file_2'},
+                        {'label': "Visa step changed", 'value': 'step_changed'}
+                    ],
+                    value='matches',
+                    inline=True,
+                    className="mb-3"
+                ),
+
+                dbc.Row([
+                    dbc.Col(
+                        dbc.Switch(
+                            id='fuzzy-match',
+                            label="Fuzzy name matching",
+                            value=False
+                        ),
+                        width=12, md=4
+                    ),
+                    dbc.Col(
+                        dcc.Slider(
+                            id='fuzzy-threshold',
+                            min=0.5, max=1.0, step=0.05, value=0.85,
+                            marks={0.5: '0.5', 0.75: '0.75', 1.0: '1.0'}
+                        ),
+                        width=12, md=8
+                    )
+                ], className="mb-3"),
+
+                job_panel('compare'),
+
                 dbc.Card([
                     dbc.CardHeader("Matching Names"),
-                    dbc.CardBody(
+                    dbc.CardBody([
                         dash_table.DataTable(
                             id='matching-names-table',
                             style_data_conditional=[
@@ -187,219 +412,506 @@ app.layout = dbc.Container([
                                 'textAlign': 'left',
                                 'padding': '12px'
                             },
+                            page_action='custom',
+                            page_current=0,
+                            page_size=TABLE_PAGE_SIZE,
+                            sort_action='custom',
+                            sort_mode='multi',
+                            sort_by=[],
+                            filter_action='custom',
+                            filter_query=''
+                        ),
+                        html.Small(id='matching-names-total', className="text-muted"),
+                        dcc.Store(id='comparison-key')
+                    ])
+                ])
+            ]))
+        ]),
+
+        # Tab 4: History across daily exports
+        dbc.Tab(label="History", children=[
+            dbc.Card(dbc.CardBody([
+                dbc.Row([
+                    dbc.Col([
+                        html.H4("Upload Daily Exports"),
+                        dcc.Upload(
+                            id='upload-history',
+                            children=dbc.Card(
+                                dbc.CardBody([
+                                    html.I(className="fas fa-copy fa-2x mb-3"),
+                                    html.H5("Drag and Drop or Click to Upload Several Files")
+                                ], className="text-center"),
+                                className="border-dashed"
+                            ),
+                            multiple=True,
+                            className="mb-2"
+                        ),
+                        html.Small("Each file is filed under the date in its name (YYYY-MM-DD), "
+                                   "or else its last-modified date.", className="text-muted"),
+                        job_panel('history'),
+                        html.Div(id='history-status', className="mt-2")
+                    ], width=12, md=8),
+                    dbc.Col([
+                        html.H5("Window"),
+                        dbc.Select(
+                            id='history-window',
+                            options=[
+                                {'label': "Last 30 days", 'value': '30'},
+                                {'label': "Last 60 days", 'value': '60'},
+                                {'label': "Last 90 days", 'value': '90'},
+                                {'label': "Everything", 'value': '0'}
+                            ],
+                            value=str(pipeline.HISTORY_DAYS) if pipeline.HISTORY_DAYS in (30, 60, 90) else '90'
+                        ),
+                        html.Div(id='history-summary', className="text-muted mt-2")
+                    ], width=12, md=4)
+                ], className="mb-4"),
+
+                dbc.Card([
+                    dbc.CardHeader("Category Counts Over Time"),
+                    dbc.CardBody(dcc.Graph(id='history-trend-chart'))
+                ], className="mb-4"),
+
+                dbc.Card([
+                    dbc.CardHeader("Days Spent per Visa Step"),
+                    dbc.CardBody(dcc.Graph(id='history-dwell-chart'))
+                ], className="mb-4"),
+
+                dbc.Card([
+                    dbc.CardHeader([
+                        html.H5("Bottleneck Steps", className="mb-0 text-danger"),
+                        html.Small("Steps cases stay in longest before moving on", className="text-muted")
+                    ]),
+                    dbc.CardBody([
+                        dash_table.DataTable(
+                            id='bottleneck-table',
+                            style_data_conditional=[
+                                {
+                                    'if': {'row_index': 'odd'},
+                                    'backgroundColor': 'rgba(248, 249, 250, 0.5)'
+                                }
+                            ],
+                            style_header={
+                                'backgroundColor': '#f8f9fa',
+                                'fontWeight': 'bold'
+                            },
+                            style_cell={
+                                'textAlign': 'left',
+                                'padding': '12px'
+                            },
                             sort_action='native'
                         )
-                    )
+                    ])
                 ])
             ]))
         ])
     ])
 ], fluid=True)
 
-def parse_contents(contents, filename):
-    """Parse uploaded Excel file contents"""
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
-    
-    try:
-        if 'xlsx' not in filename.lower():
-            return None, "Please upload an Excel file."
-            
-        df = pd.read_excel(io.BytesIO(decoded))
-        return df, None
-    except Exception as e:
-        return None, str(e)
-
-def process_data(df):
-    """Process data into categories based on visa step and other conditions"""
-    # Initialize categories
-    categories = {}
-    
-    # Special handling for medical and bio appointments
-    both_medical_and_bio = df[
-        df['Current Visa Step'].str.contains('Pending maid to go for EID Biometrics', na=False) & 
-        df['Current Visa Step'].str.contains('Waiting for the maid to go to medical test and EID fingerprinting', na=False)
-    ]
-    
-    only_medical = df[
-        ~df.index.isin(both_medical_and_bio.index) & 
-        df['Current Visa Step'].str.contains('Waiting for the maid to go to medical test and EID fingerprinting', na=False)
-    ]
-    
-    only_bio = df[
-        ~df.index.isin(both_medical_and_bio.index) & 
-        df['Current Visa Step'].str.contains('EID fingerprinting', na=False)
-    ]
-    
-    # Add these to categories
-    categories['Push for medical and book bio'] = both_medical_and_bio
-    categories['Push for medical'] = only_medical
-    categories['Push to book bio appointment'] = only_bio
-    
-    # Other categories
-    categories['As Aya to book Bio Appointment'] = df[
-        ~df.index.isin(both_medical_and_bio.index) & 
-        ~df.index.isin(only_medical.index) & 
-        ~df.index.isin(only_bio.index) & 
-        df['Current Visa Step'].str.contains('Prepare EID application', na=False)
-    ]
-    
-    categories['Apply Entry Visa'] = df[
-        df['Current Visa Step'].str.contains('Apply for entry Visa', na=False)
-    ]
-    
-    categories['Create Offer Letter'] = df[
-        df['Current Visa Step'].str.contains('Create Regular Offer Letter', na=False)
-    ]
-    
-    categories['Check Complaints'] = df[
-        df['Current Visa Step'].str.contains('Waiting for the PRO Update|Pending to fix MOHRE issue', 
-                                           na=False, regex=True)
-    ]
-    
-    categories['Coaches'] = df[
-        df['pending arrival task'].str.contains('STAND_UP_SHOOTING|MATCHING TYPES AND DATA GATHERING', 
-                                              na=False, regex=True)
-    ]
-    
-    categories['Onboarding'] = df[
-        df['pending arrival task'].str.contains('TAWJEEH_TRAINING|ORIENTATION|UPLOAD_CERTIFICATE|MAID_INFO', 
-                                              na=False, regex=True)
-    ]
-    
-    categories['Media'] = df[
-        df['pending arrival task'].str.contains('VIDEO_EDITING', na=False)
-    ]
-    
-    categories['Apply for GCC'] = df[
-        (df['Nationality'].isin(['Ugandan', 'Kenyan'])) & 
-        (df['GCC'] == 'No') & 
-        df['GCC Application Reference Number Upload Date'].isna()
-    ]
-    
-    # Add remaining rows to "unmatched" category
-    all_matched = pd.concat([df_ for df_ in categories.values()]).index
-    categories['Unmatched'] = df[~df.index.isin(all_matched)]
-    
-    return categories
+# /metrics sums the per-process stage totals written by pipeline.timed() in
+# the Prometheus text format, and every request is timed as a stage of its
+# own. With PROFILE_DIR set, a request carrying ?profile=1, an X-Profile
+# header or a profile=1 cookie is run under cProfile and the stats are
+# dumped to that directory, along with those of any job it starts.
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+def _metric_label(value):
+    """Escape a Prometheus label value"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+@app.server.route('/metrics')
+def metrics():
+    """Stage timings of all processes in the Prometheus text format"""
+    totals = metrics_totals()
+    lines = ["# HELP preavailable_stage_seconds Wall time of instrumented stages",
+             "# TYPE preavailable_stage_seconds histogram"]
+    for stage, m in sorted(totals.items()):
+        label = f'stage="{_metric_label(stage)}"'
+        for bound, count in zip(METRICS_BUCKETS, m['buckets']):
+            lines.append(f'preavailable_stage_seconds_bucket{{{label},le="{bound}"}} {count}')
+        lines.append(f'preavailable_stage_seconds_bucket{{{label},le="+Inf"}} {m["count"]}')
+        lines.append(f'preavailable_stage_seconds_sum{{{label}}} {m["seconds"]:.6f}')
+        lines.append(f'preavailable_stage_seconds_count{{{label}}} {m["count"]}')
+    for name, key, kind, help_text in [
+        ('preavailable_stage_rows_total', 'rows', 'counter', "Rows processed by instrumented stages"),
+        ('preavailable_stage_bytes_total', 'bytes', 'counter', "Payload bytes read or written by instrumented stages"),
+        ('preavailable_stage_peak_bytes', 'peak_bytes', 'gauge', "Largest traced allocation peak of a stage"),
+    ]:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for stage, m in sorted(totals.items()):
+            lines.append(f'{name}{{stage="{_metric_label(stage)}"}} {m[key]}')
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+def _request_stage():
+    """Stage name for a request: the callback function for Dash updates, else the endpoint"""
+    if request.path.endswith('/_dash-update-component'):
+        body = request.get_json(silent=True) or {}
+        callback = app.callback_map.get(body.get('output'), {}).get('callback')
+        name = getattr(callback, '__name__', None) or body.get('output', 'unknown')
+        return f"callback.{name}"
+    return f"route.{request.endpoint}"
+
+@app.server.before_request
+def start_request_metrics():
+    """Start timing (and optionally profiling) a request"""
+    g.metrics_start = time.perf_counter()
+    if PROFILE_DIR and (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+                        or request.cookies.get('profile') == '1'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def job_profile_dir():
+    """PROFILE_DIR if the current request is profiled, for the jobs it starts"""
+    return PROFILE_DIR if has_request_context() and g.get('profiler') is not None else None
+
+@app.server.after_request
+def finish_request_metrics(response):
+    """Record a request's time and payload sizes, and dump its profile if one ran"""
+    start = g.pop('metrics_start', None)
+    if start is None or request.endpoint in ('static', 'metrics') or request.path.startswith('/_dash-component-suites'):
+        return response
+    stage = _request_stage()
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = re.sub(r'[^\w.-]+', '_', stage)
+        profiler.dump_stats(os.path.join(
+            PROFILE_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{name}_{uuid.uuid4().hex[:6]}.prof"))
+    record_stage(stage, time.perf_counter() - start,
+                 nbytes=(request.content_length or 0) + (response.content_length or 0))
+    return response
+
+# Category rules and visa thresholds come from pipeline.RULES_FILE. Each
+# worker checks the file between requests, so edits apply without a restart.
+@app.server.before_request
+def refresh_rules():
+    """Pick up edits to the rules file"""
+    pipeline.reload_rules()
+
+# Large workbooks can bypass dcc.Upload: the browser posts the file to
+# /upload, which streams it to disk in chunks while hashing it, and only the
+# resulting token travels through the Dash callbacks.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+app.server.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MAX_UPLOAD_MB", 500)) * 1024 * 1024
+
+@app.server.route('/upload', methods=['POST'])
+def upload_file():
+    """Stream a multipart file upload to disk and return its token"""
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': "No file was uploaded."}), 400
+    if not upload.filename.lower().endswith(('.xlsx', '.csv')):
+        return jsonify({'error': "Please upload an Excel or CSV file."}), 400
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    remove_expired_files(UPLOAD_DIR)
 
-def calculate_days_since_landing(landing_date):
-    """Calculate days since landing date"""
-    if pd.isna(landing_date):
+    digest = hashlib.sha1()
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix='.part')
+    with os.fdopen(fd, 'wb') as out:
+        while True:
+            chunk = upload.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+
+    token = digest.hexdigest()[:16]
+    os.replace(tmp_path, streamed_upload_path(token))
+    return jsonify({'token': token, 'filename': upload.filename})
+
+# Server-side cache of parsed uploads, keyed by a hash of the file contents.
+# Callbacks only pass the short token around instead of the base64 blob.
+# Table frames behind the paged DataTables are cached the same way.
+#
+# Each WSGI worker process keeps its own in-memory LRU. Parsed uploads are
+# shared between workers through their Arrow snapshots, and table frames are
+# written through to SHARED_CACHE_DIR, so a paging or download request can be
+# answered by any worker, not just the one that processed the upload.
+UPLOAD_CACHE_SIZE = int(os.environ.get("UPLOAD_CACHE_SIZE", 8))
+TABLE_CACHE_SIZE = int(os.environ.get("TABLE_CACHE_SIZE", 32))
+_upload_cache = OrderedDict()
+_table_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _cache_get(cache, key):
+    """Look up a key in an LRU cache, marking it most recently used"""
+    if key is None:
         return None
-    try:
-        landing = pd.to_datetime(landing_date)
-        today = pd.Timestamp.now()
-        return (today - landing).days
-    except:
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+def _cache_put(cache, key, value, limit):
+    """Insert into an LRU cache, evicting the least recently used entries"""
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+def upload_token(data):
+    """Return a short content-hash token for the bytes of an uploaded file"""
+    return hashlib.sha1(data).hexdigest()[:16]
+
+def _load_upload(token, filename, read):
+    """Return a cached upload, falling back to its snapshot and then to read()"""
+    entry = get_cached_upload(token)
+    if entry is not None:
+        return token, entry, None
+
+    entry, error = read_upload_entry(token, filename, read)
+    if error:
+        return None, None, error
+
+    _cache_put(_upload_cache, token, entry, UPLOAD_CACHE_SIZE)
+    return token, entry, None
+
+def stage_upload(contents, filename):
+    """Save a dcc.Upload file to disk so a background job can read it"""
+    if not filename.lower().endswith(('.xlsx', '.csv')):
+        return None, "Please upload an Excel or CSV file."
+    data = decode_contents(contents)
+    token = upload_token(data)
+    path = streamed_upload_path(token)
+    if not os.path.exists(path) and snapshot_path(token) is None:
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix='.part')
+        with os.fdopen(fd, 'wb') as out:
+            out.write(data)
+        os.replace(tmp_path, path)
+    return token, None
+
+def open_snapshot(token):
+    """Reopen a previous upload from its snapshot"""
+    return _load_upload(token, None,
+                        lambda: (None, "That upload is no longer available."))
+
+def get_cached_upload(token):
+    """Look up a cached upload by token, or None if it was evicted"""
+    entry = _cache_get(_upload_cache, token)
+    if entry is None and token is not None:
+        # Large uploads are not snapshotted; their job shares the entry instead
+        entry = shared_get(f"streamed:{token}")
+        if entry is not None:
+            _cache_put(_upload_cache, token, entry, UPLOAD_CACHE_SIZE)
+    return entry
+
+def store_table(key, frame):
+    """Keep a table frame server-side for paging, sorting and filtering"""
+    _cache_put(_table_cache, key, frame, TABLE_CACHE_SIZE)
+    shared_put(f"table:{key}", frame)
+    return frame
+
+def get_table(key):
+    """Look up a cached table frame, or None if it was evicted"""
+    frame = _cache_get(_table_cache, key)
+    if frame is None and key is not None:
+        # Stored by another worker process
+        frame = shared_get(f"table:{key}")
+        if frame is not None:
+            _cache_put(_table_cache, key, frame, TABLE_CACHE_SIZE)
+    return frame
+
+def frame_records(frame):
+    """DataTable records built column-wise, with missing values as None"""
+    columns = [frame[col].astype(object).where(frame[col].notna(), None).tolist()
+               for col in frame.columns]
+    return [dict(zip(frame.columns, values)) for values in zip(*columns)]
+
+def poll_job(job, on_done):
+    """Progress outputs for a job store, passing a finished result to on_done"""
+    hidden = {'display': 'none'}
+    if not job:
+        return 0, "", hidden, True, None
+    if 'error' in job or 'result' in job:
+        return 0, "", hidden, True, job.get('result', job)
+    status = job_status(job['id'])
+    if status['state'] == 'running':
+        return status['percent'], status['stage'], {}, False, no_update
+    forget_job(job['id'])
+    if status['state'] == 'missing':
+        return 0, "", hidden, True, {'error': "The job is no longer available, please try again."}
+    result = status['result']
+    return 100, "", hidden, True, result if 'error' in result else on_done(result)
+
+# Server-side paging: the tables use Dash's 'custom' page/sort/filter actions
+# and each request is answered from the cached table frame
+FILTER_OPERATORS = [['ge ', '>='],
+                    ['le ', '<='],
+                    ['lt ', '<'],
+                    ['gt ', '>'],
+                    ['ne ', '!='],
+                    ['eq ', '='],
+                    ['contains '],
+                    ['datestartswith ']]
+
+def split_filter_part(filter_part):
+    """Split one DataTable filter expression into column, operator and value"""
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1:-1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+def filter_frame(frame, filter_query):
+    """Apply a DataTable filter_query to a frame"""
+    for filter_part in (filter_query or '').split(' && '):
+        col_name, operator, value = split_filter_part(filter_part)
+        if col_name not in frame.columns:
+            continue
+        col = frame[col_name]
+        if operator in ('contains', 'datestartswith'):
+            text = col.astype('string')
+            if operator == 'contains':
+                mask = text.str.contains(str(value), case=False, regex=False)
+            else:
+                mask = text.str.startswith(str(value))
+        else:
+            if isinstance(value, float) and not pd.api.types.is_numeric_dtype(col):
+                value = str(int(value)) if value.is_integer() else str(value)
+            compare = {'eq': col.eq, 'ne': col.ne, 'lt': col.lt,
+                       'le': col.le, 'gt': col.gt, 'ge': col.ge}[operator]
+            mask = compare(value)
+        frame = frame[mask.fillna(False).to_numpy(dtype=bool)]
+    return frame
+
+def page_table(key, page_current, page_size, sort_by, filter_query, cross_filters=None):
+    """One page of a cached table after filtering and sorting, with a row count"""
+    frame = get_table(key)
+    if frame is None:
+        return [], 1, ""
+    with timed('table.page', rows=len(frame)):
+        if cross_filters is not None:
+            frame = frame[cross_filter_mask(frame, cross_filters)].drop(columns='Categories')
+        return _page_frame(frame, page_current, page_size, sort_by, filter_query)
+
+def _page_frame(frame, page_current, page_size, sort_by, filter_query):
+    """Filter, sort and slice a table frame into DataTable records"""
+    total = len(frame)
+    frame = filter_frame(frame, filter_query)
+    if sort_by:
+        frame = frame.sort_values(
+            [col['column_id'] for col in sort_by],
+            ascending=[col['direction'] == 'asc' for col in sort_by],
+            kind='stable'
+        )
+    page_size = page_size or TABLE_PAGE_SIZE
+    page_count = max(1, -(-len(frame) // page_size))
+    start = min(page_current or 0, page_count - 1) * page_size
+    if len(frame) == total:
+        summary = f"{total:,} rows"
+    else:
+        summary = f"{len(frame):,} of {total:,} rows match the filter"
+    return frame_records(frame.iloc[start:start + page_size]), page_count, summary
+
+@app.callback(
+    Output('analytics-job', 'data'),
+    [Input('upload-data', 'contents'),
+     Input('streamed-upload', 'data'),
+     Input('snapshot-select', 'value')],
+    [State('upload-data', 'filename')]
+)
+def start_analytics_job(contents, streamed, snapshot, filename):
+    """Queue the processing of a new upload, or reuse a cached result"""
+    if ctx.triggered_id == 'snapshot-select' and snapshot:
+        token, filename = snapshot, None
+    elif ctx.triggered_id == 'streamed-upload' and streamed:
+        if 'error' in streamed:
+            return {'error': streamed['error']}
+        token, filename = streamed['token'], streamed['filename']
+    elif contents is not None:
+        token, error = stage_upload(contents, filename)
+        if error:
+            return {'error': error}
+    else:
         return None
+    
+    entry = get_cached_upload(token)
+    if entry is not None and analytics_current(entry.get('analytics')):
+        return {'result': {'token': token}}
+    return {'id': submit_job(analytics_job, token, filename, profile_dir=job_profile_dir())}
+
+def accept_analytics_result(result):
+    """Cache a finished analytics job's upload in the web process and start its export"""
+    _cache_put(_upload_cache, result['token'], result['entry'], UPLOAD_CACHE_SIZE)
+    prebuild_export(result['token'], result['entry']['filename'], profile_dir=job_profile_dir())
+    return {'token': result['token']}
 
 @app.callback(
-    [Output('total-count', 'children'),
-     Output('live-in-count', 'children'),
-     Output('live-out-count', 'children'),
-     Output('nationality-chart', 'figure'),
-     Output('visa-alerts-table', 'data'),
+    [Output('analytics-progress', 'value'),
+     Output('analytics-progress-label', 'children'),
+     Output('analytics-job-panel', 'style'),
+     Output('analytics-poll', 'disabled'),
+     Output('analytics-result', 'data')],
+    [Input('analytics-poll', 'n_intervals'),
+     Input('analytics-job', 'data')]
+)
+def poll_analytics_job(n_intervals, job):
+    """Report progress of the analytics job and publish its result"""
+    return poll_job(job, accept_analytics_result)
+
+@app.callback(
+    Output('analytics-cancel', 'data'),
+    Input('btn-cancel-analytics', 'n_clicks'),
+    State('analytics-job', 'data'),
+    prevent_initial_call=True
+)
+def cancel_analytics_job(n_clicks, job):
+    """Cancel the running analytics job"""
+    if job and 'id' in job:
+        cancel_job(job['id'])
+    return n_clicks
+
+@app.callback(
+    [Output('visa-alerts-table', 'page_current'),
      Output('visa-alerts-table', 'columns'),
-     Output('at-risk-table', 'data'),
+     Output('at-risk-table', 'page_current'),
      Output('at-risk-table', 'columns'),
      Output('upload-status', 'children'),
      Output('btn-download', 'disabled'),
-     Output('sheet-counts', 'children')],
-    [Input('upload-data', 'contents')],
-    [State('upload-data', 'filename')]
+     Output('sheet-counts', 'children'),
+     Output('upload-token', 'data')],
+    [Input('analytics-result', 'data')]
 )
-def update_analytics(contents, filename):
+def update_analytics(result):
     """Update analytics based on uploaded file"""
-    if contents is None:
-        return "0", "0", "0", {}, [], [], [], [], "", True, ""
+    if result is None:
+        return 0, [], 0, [], "", True, "", None
     
-    df, error = parse_contents(contents, filename)
+    if 'error' in result:
+        token, entry, error = None, None, result['error']
+    else:
+        with timed('analytics.open'):
+            token, entry, error = open_snapshot(result['token'])
     if error:
-        return "0", "0", "0", {}, [], [], [], [], html.Div(error, style={'color': 'red'}), True, ""
+        return 0, [], 0, [], html.Div(error, style={'color': 'red'}), True, "", None
     
-    # Process data
-    categories = process_data(df)
+    analytics = get_analytics(entry)
     
-    # Calculate counts
-    total_count = len(df)
-    df['Live out type'] = df['Live out type'].fillna('')
-    live_in_count = len(df[df['Live out type'].str.strip() == 'CC'])
-    live_out_count = len(df[df['Live out type'].str.strip() == 'CC (Live out)'])
-    
-    # Create nationality chart
-    nationality_data = []
-    for nat in df['Nationality'].unique():
-        if pd.notna(nat):
-            live_in = len(df[(df['Nationality'] == nat) & (df['Live out type'].str.strip() == 'CC')])
-            live_out = len(df[(df['Nationality'] == nat) & (df['Live out type'].str.strip() == 'CC (Live out)')])
-            if live_in > 0 or live_out > 0:
-                nationality_data.append({
-                    'Nationality': nat,
-                    'Live In': live_in,
-                    'Live Out': live_out
-                })
-    
-    fig = px.bar(nationality_data, 
-                 x='Nationality',
-                 y=['Live In', 'Live Out'],
-                 barmode='group',
-                 title='Nationality Distribution',
-                 color_discrete_sequence=['#28a745', '#17a2b8'])
-    
-    # Process visa alerts and at-risk cases
-    df['Days Since Landing'] = df['Landed In Dubai'].apply(calculate_days_since_landing)
-    
-    # Define thresholds
-    entry_visa_alert_threshold = 3
-    entry_visa_risk_threshold = 2
-    tourist_visa_alert_threshold = 8
-    tourist_visa_risk_threshold = 7
-    
-    # Process exceeded threshold (alerts)
-    visa_alerts = df[
-        ((df['Type of Visa'] == 'Entry Visa') & (df['Days Since Landing'] > entry_visa_alert_threshold)) |
-        ((df['Type of Visa'].isin(['Tourist Visa', '']) | df['Type of Visa'].isna()) & 
-         (df['Days Since Landing'] > tourist_visa_alert_threshold))
-    ].sort_values('Days Since Landing', ascending=False)
-    
-    # Process at-risk cases (1 day before alert threshold)
-    at_risk = df[
-        ((df['Type of Visa'] == 'Entry Visa') & (df['Days Since Landing'] == entry_visa_risk_threshold)) |
-        ((df['Type of Visa'].isin(['Tourist Visa', '']) | df['Type of Visa'].isna()) & 
-         (df['Days Since Landing'] == tourist_visa_risk_threshold))
-    ].sort_values('Days Since Landing', ascending=False)
-    
-    alerts_data = []
-    for _, row in visa_alerts.iterrows():
-        alerts_data.append({
-            'Housemaid Name': row['Housemaid Name'],
-            'Type of Visa': row['Type of Visa'],
-            'Landed In Dubai': row['Landed In Dubai'],
-            'Days Since Landing': row['Days Since Landing'],
-            'Live Type': 'Live In' if str(row['Live out type']).strip() == 'CC' 
-                        else 'Live Out' if str(row['Live out type']).strip() == 'CC (Live out)' 
-                        else 'Unknown',
-            'Visa Step': str(row['Current Visa Step'])
-        })
-    
-    at_risk_data = []
-    for _, row in at_risk.iterrows():
-        at_risk_data.append({
-            'Housemaid Name': row['Housemaid Name'],
-            'Type of Visa': row['Type of Visa'],
-            'Landed In Dubai': row['Landed In Dubai'],
-            'Days Since Landing': row['Days Since Landing'],
-            'Live Type': 'Live In' if str(row['Live out type']).strip() == 'CC' 
-                        else 'Live Out' if str(row['Live out type']).strip() == 'CC (Live out)' 
-                        else 'Unknown',
-            'Visa Step': str(row['Current Visa Step']),
-            'Threshold': f"{entry_visa_alert_threshold} days" if row['Type of Visa'] == 'Entry Visa' 
-                        else f"{tourist_visa_alert_threshold} days"
-        })
+    with timed('analytics.store_tables'):
+        store_table(f"{token}:summary", analytics['summary'])
+        store_table(f"{token}:visa-alerts", analytics['visa_alerts'])
+        store_table(f"{token}:at-risk", analytics['at_risk'])
     
     alerts_columns = [
         {"name": "Name", "id": "Housemaid Name"},
+        {"name": "Nationality", "id": "Nationality"},
         {"name": "Visa Type", "id": "Type of Visa"},
         {"name": "Landing Date", "id": "Landed In Dubai"},
         {"name": "Days Since Landing", "id": "Days Since Landing"},
@@ -409,9 +921,11 @@ def update_analytics(contents, filename):
     
     at_risk_columns = [
         {"name": "Name", "id": "Housemaid Name"},
+        {"name": "Nationality", "id": "Nationality"},
         {"name": "Visa Type", "id": "Type of Visa"},
         {"name": "Landing Date", "id": "Landed In Dubai"},
         {"name": "Days Since Landing", "id": "Days Since Landing"},
+        {"name": "Days Until Breach", "id": "Days Until Breach"},
         {"name": "Live Type", "id": "Live Type"},
         {"name": "Visa Step", "id": "Visa Step"},
         {"name": "Threshold", "id": "Threshold"}
@@ -425,154 +939,562 @@ def update_analytics(contents, filename):
                 dbc.Col(
                     dbc.Card(dbc.CardBody([
                         html.H6(name, className="mb-2"),
-                        html.H4(str(len(df_cat)), className="text-primary text-center")
+                        html.H4(str(count), className="text-primary text-center")
                     ])),
                     width=12, md=6, lg=4, className="mb-3"
                 )
-                for name, df_cat in categories.items()
-                if len(df_cat) > 0
+                for name, count in category_counts(analytics['summary']).items()
+                if count > 0
             ])
         ])
     ])
     
+    date_failures = analytics['date_failures']
+    upload_status = [html.Div("File processed successfully!", className="text-success")]
+    if date_failures:
+        upload_status.append(html.Div(
+            f"{date_failures:,} 'Landed In Dubai' values could not be read as dates "
+            "and were left out of the visa alerts.",
+            className="text-warning"
+        ))
+    
     return (
-        f"{total_count:,}",
-        f"{live_in_count:,}",
-        f"{live_out_count:,}",
-        fig,
-        alerts_data,
+        0,
         alerts_columns,
-        at_risk_data,
+        0,
         at_risk_columns,
-        html.Div("File processed successfully!", className="text-success"),
+        upload_status,
         False,
-        sheet_counts
+        sheet_counts,
+        token
     )
 
+# The per-upload summary is a cube of row counts over every filterable
+# dimension, so the cross-filters below re-aggregate a few thousand rows
+# instead of touching the upload.
+FILTER_OUTPUTS = {
+    'Nationality': 'filter-nationality',
+    'Type of Visa': 'filter-visa-type',
+    'Live Type': 'filter-live-type',
+    'Category': 'filter-category',
+}
+
+def filtered_summary(token, filters):
+    """The analytics summary of an upload restricted to the cross-filters"""
+    summary = get_table(f"{token}:summary")
+    if summary is None or not filters:
+        return summary
+    with timed('analytics.filter', rows=len(summary)):
+        return summary[cross_filter_mask(summary, filters)]
+
 @app.callback(
-    Output("download-dataframe-xlsx", "data"),
-    Input("btn-download", "n_clicks"),
-    State('upload-data', 'contents'),
-    State('upload-data', 'filename'),
-    prevent_initial_call=True
+    [Output(component, prop) for component in FILTER_OUTPUTS.values() for prop in ('options', 'value')] +
+    [Output('filter-landed', 'start_date'),
+     Output('filter-landed', 'end_date'),
+     Output('filter-landed', 'min_date_allowed'),
+     Output('filter-landed', 'max_date_allowed')],
+    [Input('upload-token', 'data')]
 )
-def download_excel(n_clicks, contents, filename):
-    """Create and download processed Excel file"""
-    if contents is None:
-        return None
-    
-    df, error = parse_contents(contents, filename)
-    if error:
+def update_filter_options(token):
+    """Offer the values present in an upload and clear the previous upload's filters"""
+    summary = get_table(f"{token}:summary")
+    outputs = []
+    for col in CROSS_FILTERS:
+        if summary is None:
+            values = []
+        elif col == 'Category':
+            values = [name for name, count in category_counts(summary).items() if count > 0]
+        else:
+            values = sorted(summary[col].dropna().astype(str).unique())
+        outputs += [[{'label': value, 'value': value} for value in values], None]
+    landed = None if summary is None else summary['Landed In Dubai'].dropna()
+    if landed is None or landed.empty:
+        return outputs + [None, None, None, None]
+    return outputs + [None, None, landed.min().strftime('%Y-%m-%d'), landed.max().strftime('%Y-%m-%d')]
+
+@app.callback(
+    Output('analytics-filter', 'data'),
+    [Input(component, 'value') for component in FILTER_OUTPUTS.values()] +
+    [Input('filter-landed', 'start_date'),
+     Input('filter-landed', 'end_date')]
+)
+def update_analytics_filter(nationality, visa_type, live_type, category, start, end):
+    """Combine the filter controls into one selection shared by every widget"""
+    filters = dict(zip(CROSS_FILTERS, [nationality, visa_type, live_type, category]), start=start, end=end)
+    return {key: value for key, value in filters.items() if value}
+
+@app.callback(
+    [Output('total-count', 'children'),
+     Output('live-in-count', 'children'),
+     Output('live-out-count', 'children')],
+    [Input('upload-token', 'data'),
+     Input('analytics-filter', 'data')]
+)
+def update_counters(token, filters):
+    """Total, Live In and Live Out counts of the filtered upload"""
+    summary = filtered_summary(token, filters)
+    if summary is None:
+        return "0", "0", "0"
+    counts = summary_counts(summary)
+    return (f"{counts['total_count']:,}", f"{counts['live_in_count']:,}",
+            f"{counts['live_out_count']:,}")
+
+# The chart's traces are fixed, so updates only send the bar arrays and
+# titles as a Patch. Arrays are cached by the content hash of the summary
+# they come from, so re-selecting a grouping or reopening an upload with the
+# same aggregate does no work.
+CHART_CACHE_SIZE = int(os.environ.get("CHART_CACHE_SIZE", 64))
+_chart_cache = OrderedDict()
+
+def breakdown_arrays(summary, by):
+    """Category labels and Live In / Live Out counts for the distribution chart"""
+    digest = hashlib.sha1(pd.util.hash_pandas_object(summary, index=False).to_numpy().tobytes())
+    key = f"{digest.hexdigest()}:{by}"
+    arrays = _cache_get(_chart_cache, key)
+    if arrays is None:
+        table = summary_breakdown(summary, by)
+        arrays = {
+            'x': table[by].astype(str).tolist(),
+            'Live In': table['Live In'].astype(int).tolist(),
+            'Live Out': table['Live Out'].astype(int).tolist(),
+        }
+        _cache_put(_chart_cache, key, arrays, CHART_CACHE_SIZE)
+    return arrays
+
+@app.callback(
+    Output('nationality-chart', 'figure'),
+    [Input('upload-token', 'data'),
+     Input('breakdown-by', 'value'),
+     Input('analytics-filter', 'data')]
+)
+def update_breakdown_chart(token, by, filters):
+    """Live In / Live Out bar chart grouped by nationality, visa type or category"""
+    by = by if by in BREAKDOWNS else 'Nationality'
+    summary = filtered_summary(token, filters)
+    with timed('chart.build', rows=None if summary is None else len(summary)):
+        arrays = ({'x': [], 'Live In': [], 'Live Out': []} if summary is None
+                  else breakdown_arrays(summary, by))
+        patch = Patch()
+        for i, trace in enumerate(['Live In', 'Live Out']):
+            patch['data'][i]['x'] = arrays['x']
+            patch['data'][i]['y'] = arrays[trace]
+        patch['layout']['title']['text'] = BREAKDOWNS[by] if summary is not None else ""
+        patch['layout']['xaxis']['title']['text'] = by if summary is not None else ""
+        return patch
+
+def forecast_calendar(forecast):
+    """Two-week calendar of the breach forecast, shaded by the number of breaches"""
+    busiest = max(int(forecast['Total'].max()), 1)
+    cells = [
+        html.Td([
+            html.Div(pd.Timestamp(row['Date']).strftime('%a %d %b'), className="small text-muted"),
+            html.Div(str(row['Total']), className="fs-5 fw-bold"),
+            html.Div(f"{row['Entry Visa']} entry / {row['Tourist Visa']} tourist", className="small")
+        ], style={'backgroundColor': f"rgba(255, 193, 7, {0.6 * row['Total'] / busiest:.2f})"})
+        for row in forecast.to_dict('records')
+    ]
+    weeks = [html.Tr(cells[i:i + 7]) for i in range(0, len(cells), 7)]
+    return html.Table(html.Tbody(weeks), className="table table-bordered text-center mb-0")
+
+@app.callback(
+    [Output('breach-forecast', 'children'),
+     Output('visa-alerts-rule', 'children'),
+     Output('at-risk-rule', 'children')],
+    [Input('upload-token', 'data'),
+     Input('analytics-filter', 'data')]
+)
+def update_breach_forecast(token, filters):
+    """Breach counts by horizon and the forecast calendar for an upload"""
+    thresholds = visa_thresholds()
+    alert_rule = (f"Entry Visa: >{thresholds['entry_visa_alert']} days, "
+                  f"Tourist Visa: >{thresholds['tourist_visa_alert']} days")
+    risk_rule = (f"Entry Visa: {thresholds['entry_visa_risk']}-{thresholds['entry_visa_alert']} days, "
+                 f"Tourist Visa: {thresholds['tourist_visa_risk']}-{thresholds['tourist_visa_alert']} days")
+    summary = filtered_summary(token, filters)
+    if summary is None:
+        return "", alert_rule, risk_rule
+    with timed('forecast.render'):
+        forecast = breach_forecast(summary)
+        buckets = dbc.Row([
+            dbc.Col(dbc.Card(dbc.CardBody([
+                html.H6(label, className="text-muted"),
+                html.H3(f"{count:,}", className="text-warning text-center")
+            ])), width=6, md=3, className="mb-3")
+            for label, count in forecast_buckets(forecast).items()
+        ])
+        return [buckets, forecast_calendar(forecast)], alert_rule, risk_rule
+
+@app.callback(
+    [Output('visa-alerts-table', 'data'),
+     Output('visa-alerts-table', 'page_count'),
+     Output('visa-alerts-total', 'children')],
+    [Input('upload-token', 'data'),
+     Input('visa-alerts-table', 'page_current'),
+     Input('visa-alerts-table', 'page_size'),
+     Input('visa-alerts-table', 'sort_by'),
+     Input('visa-alerts-table', 'filter_query'),
+     Input('analytics-filter', 'data')]
+)
+def page_visa_alerts(token, page_current, page_size, sort_by, filter_query, filters):
+    """Serve the visible page of the visa alerts table"""
+    return page_table(f"{token}:visa-alerts", page_current, page_size, sort_by, filter_query,
+                      filters or {})
+
+@app.callback(
+    [Output('at-risk-table', 'data'),
+     Output('at-risk-table', 'page_count'),
+     Output('at-risk-total', 'children')],
+    [Input('upload-token', 'data'),
+     Input('at-risk-table', 'page_current'),
+     Input('at-risk-table', 'page_size'),
+     Input('at-risk-table', 'sort_by'),
+     Input('at-risk-table', 'filter_query'),
+     Input('analytics-filter', 'data')]
+)
+def page_at_risk(token, page_current, page_size, sort_by, filter_query, filters):
+    """Serve the visible page of the at-risk table"""
+    return page_table(f"{token}:at-risk", page_current, page_size, sort_by, filter_query,
+                      filters or {})
+
+@app.callback(
+    [Output('changes-table', 'data'),
+     Output('changes-table', 'page_count'),
+     Output('changes-total', 'children'),
+     Output('changes-title', 'children')],
+    [Input('upload-token', 'data'),
+     Input('changes-table', 'page_current'),
+     Input('changes-table', 'page_size'),
+     Input('changes-table', 'sort_by'),
+     Input('changes-table', 'filter_query')]
+)
+def page_changes(token, page_current, page_size, sort_by, filter_query):
+    """Serve the visible page of the changes since the previous upload"""
+    key = f"{token}:changes"
+    changes = get_table(key)
+    if changes is None:
+        return [], 1, "", "No earlier upload to compare with" if token else ""
+    previous = changes.attrs['previous']
+    title = f"Compared with {previous['filename'] or 'previous upload'}"
+    if previous['uploaded']:
+        title += f" (uploaded {previous['uploaded']})"
+    return (*page_table(key, page_current, page_size, sort_by, filter_query), title)
+
+@app.callback(
+    [Output('snapshot-select', 'options'),
+     Output('snapshot-file-1', 'options'),
+     Output('snapshot-file-2', 'options')],
+    [Input('upload-token', 'data'),
+     Input('comparison-key', 'data')]
+)
+def refresh_snapshot_options(token, comparison_key):
+    """List previous uploads in the reopen and comparison dropdowns"""
+    options = [
+        {'label': f"{snap['uploaded']} - {snap['filename']}", 'value': snap['token']}
+        for snap in list_snapshots()
+    ]
+    return options, options, options
+
+# Exports are written to EXPORT_DIR and served from disk by a Flask route,
+# so the file never passes through a callback as base64. Sheets are written
+# row by row in xlsxwriter's constant_memory mode while a thread pool converts
+# the next chunk of category rows.
+@app.server.route('/download/<token>/<fmt>')
+def download_excel(token, fmt):
+    """Create and download processed Excel file (or CSV/Parquet zip)"""
+    if fmt not in EXPORT_FORMATS or (fmt == 'parquet' and pa is None):
+        abort(404)
+
+    entry = get_cached_upload(token)
+    snapshot = snapshot_path(token) if feather is not None else None
+    if entry is None and snapshot is None:
+        abort(404)
+    filename = entry['filename'] if entry is not None else snapshot_metadata(snapshot)['filename']
+
+    path = export_path(token, fmt)
+    if not os.path.exists(path):
+        # The xlsx export is normally prebuilt once the analytics are in.
+        # Exports are built in the job pool from the staged file with every
+        # column (or from the snapshot once it has expired), and in-process
+        # from the cached frame when neither is left
+        with timed('download.wait'):
+            result = wait_for_job(submit_job(export_job, token, fmt, filename,
+                                             profile_dir=job_profile_dir()))
+        if 'error' in result:
+            if entry is None or entry['df'] is None:
+                return Response(result['error'], status=400, mimetype='text/plain')
+            build_export(token, entry, fmt)
+
+    suffix, mimetype = EXPORT_FORMATS[fmt]
+    stem = os.path.splitext(filename or token)[0]
+    return send_file(path, mimetype=mimetype, as_attachment=True,
+                     download_name=f"processed_{stem}{suffix}")
+
+@app.callback(
+    [Output('download-format', 'options'),
+     Output('download-format', 'value')],
+    Input('upload-token', 'data'),
+    State('download-format', 'value')
+)
+def update_download_formats(token, fmt):
+    """Disable the export formats the current upload can't be written in"""
+    entry = get_cached_upload(token) if token is not None else None
+    streamed = entry is not None and entry['df'] is None
+    options = [
+        {**option, 'disabled': (option['value'] == 'parquet' and pa is None)
+                               or (streamed and option['value'] not in STREAM_FORMATS)}
+        for option in DOWNLOAD_FORMATS
+    ]
+    if any(option['disabled'] and option['value'] == fmt for option in options):
+        fmt = 'xlsx'
+    return options, fmt
+
+@app.callback(
+    Output('btn-download', 'href'),
+    [Input('upload-token', 'data'),
+     Input('download-format', 'value')]
+)
+def update_download_link(token, fmt):
+    """Point the download button at the export route for the current upload"""
+    if token is None:
         return None
-    
-    categories = process_data(df)
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        for sheet_name, df_sheet in categories.items():
-            if not df_sheet.empty:
-                df_sheet.to_excel(writer, sheet_name=sheet_name[:31], index=False)
-    
-    return dcc.send_bytes(output.getvalue(), f"processed_{filename}")
+    return f"/download/{token}/{fmt or 'xlsx'}"
+
+def comparison_side(contents, snapshot, filename):
+    """Token and filename for one side of a comparison, staging a new upload"""
+    if snapshot:
+        return snapshot, None, None
+    token, error = stage_upload(contents, filename)
+    return token, filename, error
 
 @app.callback(
-    [Output('matching-names-table', 'data'),
-     Output('matching-names-table', 'columns'),
-     Output('file1-status', 'children'),
-     Output('file2-status', 'children')],
+    Output('compare-job', 'data'),
     [Input('upload-file-1', 'contents'),
-     Input('upload-file-2', 'contents')],
+     Input('upload-file-2', 'contents'),
+     Input('comparison-mode', 'value'),
+     Input('fuzzy-match', 'value'),
+     Input('fuzzy-threshold', 'value'),
+     Input('snapshot-file-1', 'value'),
+     Input('snapshot-file-2', 'value')],
     [State('upload-file-1', 'filename'),
      State('upload-file-2', 'filename')]
 )
-def compare_files(contents1, contents2, filename1, filename2):
-    """Compare names between two files"""
-    if contents1 is None or contents2 is None:
-        return [], [], "", ""
-    
-    # Parse both files
-    df1, error1 = parse_contents(contents1, filename1)
-    df2, error2 = parse_contents(contents2, filename2)
+def start_compare_job(contents1, contents2, mode, fuzzy, threshold, snapshot1, snapshot2,
+                      filename1, filename2):
+    """Queue a comparison of two files, or reuse a cached one"""
+    if (contents1 is None and not snapshot1) or (contents2 is None and not snapshot2):
+        return None
     
+    # A selected previous upload takes precedence over the file input
+    token1, filename1, error1 = comparison_side(contents1, snapshot1, filename1)
     if error1:
-        return [], [], html.Div(error1, style={'color': 'red'}), ""
+        return {'result': {'error1': error1}}
+    token2, filename2, error2 = comparison_side(contents2, snapshot2, filename2)
     if error2:
-        return [], [], "", html.Div(error2, style={'color': 'red'})
-    
-    # Find matching names with same visa step
-    matches = []
+        return {'result': {'error2': error2}}
     
-    # Check for required columns in both dataframes
-    required_columns = ['Housemaid Name', 'Current Visa Step', 'Live out type']
-    missing_columns_df1 = [col for col in required_columns if col not in df1.columns]
-    missing_columns_df2 = [col for col in required_columns if col not in df2.columns]
+    mode = mode or 'matches'
+    threshold = threshold or FUZZY_THRESHOLD
+    key = f"compare:{token1}:{token2}:{mode}:{bool(fuzzy)}:{threshold}"
+    if get_table(key) is not None:
+        return {'result': {'key': key, 'mode': mode}}
+    return {'id': submit_job(compare_job, token1, filename1, token2, filename2,
+                             mode, bool(fuzzy), threshold, profile_dir=job_profile_dir()),
+            'key': key, 'mode': mode}
+
+@app.callback(
+    [Output('compare-progress', 'value'),
+     Output('compare-progress-label', 'children'),
+     Output('compare-job-panel', 'style'),
+     Output('compare-poll', 'disabled'),
+     Output('compare-result', 'data')],
+    [Input('compare-poll', 'n_intervals'),
+     Input('compare-job', 'data')]
+)
+def poll_compare_job(n_intervals, job):
+    """Report progress of the comparison job and publish its result"""
+    def accept(result):
+        if 'frame' not in result:
+            return result
+        store_table(job['key'], result['frame'])
+        return {'key': job['key'], 'mode': job['mode']}
+    return poll_job(job, accept)
+
+@app.callback(
+    Output('compare-cancel', 'data'),
+    Input('btn-cancel-compare', 'n_clicks'),
+    State('compare-job', 'data'),
+    prevent_initial_call=True
+)
+def cancel_compare_job(n_clicks, job):
+    """Cancel the running comparison job"""
+    if job and 'id' in job:
+        cancel_job(job['id'])
+    return n_clicks
+
+@app.callback(
+    [Output('matching-names-table', 'page_current'),
+     Output('matching-names-table', 'columns'),
+     Output('file1-status', 'children'),
+     Output('file2-status', 'children'),
+     Output('comparison-key', 'data')],
+    [Input('compare-result', 'data')]
+)
+def compare_files(result):
+    """Compare names between two files"""
+    if result is None:
+        return 0, [], "", "", None
     
-    if missing_columns_df1 or missing_columns_df2:
-        error_msg = "Missing required columns: "
-        if missing_columns_df1:
-            error_msg += f"\nFile 1: {', '.join(missing_columns_df1)}"
-        if missing_columns_df2:
-            error_msg += f"\nFile 2: {', '.join(missing_columns_df2)}"
-        return [], [], html.Div(error_msg, style={'color': 'red'}), html.Div(error_msg, style={'color': 'red'})
+    if 'error' in result:
+        return 0, [], html.Div(result['error'], style={'color': 'red'}), "", None
+    if 'error1' in result or 'error2' in result:
+        error1 = result.get('error1')
+        error2 = result.get('error2')
+        return (0, [],
+                html.Div(error1, style={'color': 'red'}) if error1 else "",
+                html.Div(error2, style={'color': 'red'}) if error2 else "",
+                None)
     
-    for _, row1 in df1.iterrows():
-        name1 = row1['Housemaid Name']
-        step1 = row1['Current Visa Step']
-        
-        # Find matching rows in second file
-        matching_rows = df2[
-            (df2['Housemaid Name'] == name1) & 
-            (df2['Current Visa Step'] == step1)
-        ]
-        
-        if not matching_rows.empty:
-            # Get live type for both files
-            live_type_1 = 'Live In' if str(row1['Live out type']).strip() == 'CC' else 'Live Out' if str(row1['Live out type']).strip() == 'CC (Live out)' else 'Unknown'
-            live_type_2 = 'Live In' if str(matching_rows.iloc[0]['Live out type']).strip() == 'CC' else 'Live Out' if str(matching_rows.iloc[0]['Live out type']).strip() == 'CC (Live out)' else 'Unknown'
-            
-            match_data = {
-                'Name': name1,
-                'Current Visa Step': step1,
-                'Live Type (File 1)': live_type_1,
-                'Live Type (File 2)': live_type_2
-            }
-            
-            # Add IDs if available
-            if 'Housemaid Id' in df1.columns:
-                match_data['File 1 ID'] = row1['Housemaid Id']
-            if 'Housemaid Id' in df2.columns:
-                match_data['File 2 ID'] = matching_rows.iloc[0]['Housemaid Id']
-                
-            matches.append(match_data)
+    key = result['key']
+    matches = get_table(key)
+    if matches is None:
+        error = "The comparison has expired, please compare the files again."
+        return 0, [], html.Div(error, style={'color': 'red'}), "", None
+    noun = "matches" if result['mode'] == 'matches' else "rows"
     
-    if not matches:
+    if matches.empty:
         success_msg = html.Div([
             html.I(className="fas fa-check-circle me-2"),
-            "Files processed - No matches found"
+            f"Files processed - No {noun} found"
         ], className="text-warning")
-        return [], [], success_msg, success_msg
-    
-    # Create columns based on available data
-    columns = [
-        {'name': 'Name', 'id': 'Name'},
-        {'name': 'Current Visa Step', 'id': 'Current Visa Step'},
-        {'name': 'Live Type (File 1)', 'id': 'Live Type (File 1)'},
-        {'name': 'Live Type (File 2)', 'id': 'Live Type (File 2)'}
-    ]
-    
-    # Add ID columns if available
-    if 'Housemaid Id' in df1.columns:
-        columns.insert(2, {'name': 'File 1 ID', 'id': 'File 1 ID'})
-    if 'Housemaid Id' in df2.columns:
-        columns.insert(3 if 'File 1 ID' in [col['id'] for col in columns] else 2, 
-                      {'name': 'File 2 ID', 'id': 'File 2 ID'})
+        return 0, [], success_msg, success_msg, None
     
+    columns = [{'name': col, 'id': col} for col in matches.columns]
     success_msg = html.Div([
         html.I(className="fas fa-check-circle me-2"),
-        f"Files processed - Found {len(matches)} matches"
+        f"Files processed - Found {len(matches)} {noun}"
     ], className="text-success")
     
-    return matches, columns, success_msg, success_msg
+    return 0, columns, success_msg, success_msg, key
+
+@app.callback(
+    [Output('matching-names-table', 'data'),
+     Output('matching-names-table', 'page_count'),
+     Output('matching-names-total', 'children')],
+    [Input('comparison-key', 'data'),
+     Input('matching-names-table', 'page_current'),
+     Input('matching-names-table', 'page_size'),
+     Input('matching-names-table', 'sort_by'),
+     Input('matching-names-table', 'filter_query')]
+)
+def page_matching_names(key, page_current, page_size, sort_by, filter_query):
+    """Serve the visible page of the name comparison table"""
+    return page_table(key, page_current, page_size, sort_by, filter_query)
+
+# History mode: several daily exports are staged like single uploads, then
+# one job files them in the history store in parallel. Charts are built from
+# window queries on the store, cached per window and store state.
+@app.callback(
+    Output('history-job', 'data'),
+    Input('upload-history', 'contents'),
+    [State('upload-history', 'filename'),
+     State('upload-history', 'last_modified')]
+)
+def start_history_job(contents, filenames, last_modified):
+    """Stage several exports and queue filing them in the history store"""
+    if not contents:
+        return None
+    sources = []
+    for data, filename, modified in zip(contents, filenames, last_modified or [None] * len(contents)):
+        token, error = stage_upload(data, filename)
+        if error:
+            return {'result': {'error': f"{filename}: {error}"}}
+        fallback = (pd.Timestamp(modified, unit='s', tz='UTC').tz_convert(pipeline.LOCAL_TIMEZONE)
+                    if modified else pipeline.reference_now())
+        sources.append((token, filename, export_date(filename, fallback.strftime('%Y-%m-%d'))))
+    return {'id': submit_job(history_job, sources, profile_dir=job_profile_dir())}
+
+@app.callback(
+    [Output('history-progress', 'value'),
+     Output('history-progress-label', 'children'),
+     Output('history-job-panel', 'style'),
+     Output('history-poll', 'disabled'),
+     Output('history-result', 'data')],
+    [Input('history-poll', 'n_intervals'),
+     Input('history-job', 'data')]
+)
+def poll_history_job(n_intervals, job):
+    """Report progress of the history job and publish its result"""
+    return poll_job(job, lambda result: result)
+
+@app.callback(
+    Output('history-cancel', 'data'),
+    Input('btn-cancel-history', 'n_clicks'),
+    State('history-job', 'data'),
+    prevent_initial_call=True
+)
+def cancel_history_job(n_clicks, job):
+    """Cancel the running history job"""
+    if job and 'id' in job:
+        cancel_job(job['id'])
+    return n_clicks
+
+def get_history_analytics(days):
+    """Trend analytics for a window of the history store, shared across workers"""
+    dates = history_dates()
+    stamp = [(date, os.path.getmtime(pipeline.history_path(date))) for date in dates]
+    key = f"history:{days}:{hashlib.sha1(repr(stamp).encode()).hexdigest()}:{pipeline.rules_version()}"
+    analytics = shared_get(key)
+    if analytics is None:
+        analytics = history_analytics(load_history(days))
+        shared_put(key, analytics)
+    return analytics
+
+@app.callback(
+    [Output('history-status', 'children'),
+     Output('history-summary', 'children'),
+     Output('history-trend-chart', 'figure'),
+     Output('history-dwell-chart', 'figure'),
+     Output('bottleneck-table', 'data'),
+     Output('bottleneck-table', 'columns')],
+    [Input('history-result', 'data'),
+     Input('history-window', 'value')]
+)
+def update_history(result, window):
+    """Charts and bottleneck table for the selected window of the history store"""
+    status = ""
+    if result is not None:
+        if 'error' in result:
+            status = html.Div(result['error'], style={'color': 'red'})
+        else:
+            failed = [f"{r['file']}: {r['error']}" for r in result['files'] if 'error' in r]
+            added = [r for r in result['files'] if 'error' not in r]
+            status = [html.Div(f"Added {len(added)} exports to the history.", className="text-success")]
+            status += [html.Div(message, style={'color': 'red'}) for message in failed]
+    
+    analytics = get_history_analytics(int(window or pipeline.HISTORY_DAYS))
+    if not analytics['dates']:
+        return status, "No exports in the history yet.", {}, {}, [], []
+    summary = (f"{analytics['dates']} export dates, {analytics['ids']:,} housemaids, "
+               f"{analytics['transitions']:,} visa step changes")
+    
+    with timed('history.charts'):
+        trend = analytics['trend']
+        dates = trend.index.strftime('%Y-%m-%d').tolist()
+        trend_fig = go.Figure(
+            data=[go.Scatter(name=name, x=dates, y=trend[name].tolist(), mode='lines+markers')
+                  for name in trend.columns],
+            layout=go.Layout(xaxis={'title': {'text': "Export date"}}, yaxis={'title': {'text': "Rows"}})
+        )
+        dwell = analytics['dwell']
+        dwell_fig = go.Figure(
+            data=[go.Bar(name=str(step), x=rows['Days'].tolist(), y=rows['Runs'].tolist())
+                  for step, rows in dwell.groupby('Step', observed=True, sort=False)],
+            layout=go.Layout(barmode='stack', xaxis={'title': {'text': "Days in step before moving on"}},
+                             yaxis={'title': {'text': "Cases"}}, legend={'orientation': 'h', 'y': -0.3})
+        )
+    bottlenecks = analytics['bottlenecks'].astype({'Step': object})
+    columns = [{'name': col, 'id': col} for col in bottlenecks.columns]
+    return status, summary, trend_fig, dwell_fig, bottlenecks.to_dict('records'), columns
 
 # Add custom CSS
 app.index_string = '''
@@ -623,6 +1545,43 @@ app.index_string = '''
             {%scripts%}
             {%renderer%}
         </footer>
+        <script>
+            // Post large workbooks straight to /upload and hand the token to Dash
+            function streamUpload(file) {
+                var form = new FormData();
+                form.append('file', file);
+                var xhr = new XMLHttpRequest();
+                xhr.open('POST', '/upload');
+                xhr.onload = function () {
+                    var result;
+                    try {
+                        result = JSON.parse(xhr.responseText);
+                    } catch (e) {
+                        result = {error: 'Upload failed (' + xhr.status + ')'};
+                    }
+                    window.dash_clientside.set_props('streamed-upload', {data: result});
+                };
+                xhr.onerror = function () {
+                    window.dash_clientside.set_props('streamed-upload', {data: {error: 'Upload failed'}});
+                };
+                xhr.send(form);
+            }
+            document.addEventListener('click', function (event) {
+                if (event.target.id !== 'large-upload-link') {
+                    return;
+                }
+                event.preventDefault();
+                var input = document.createElement('input');
+                input.type = 'file';
+                input.accept = '.xlsx,.csv';
+                input.onchange = function () {
+                    if (input.files.length) {
+                        streamUpload(input.files[0]);
+                    }
+                };
+                input.click();
+            });
+        </script>
     </body>
 </html>
 '''
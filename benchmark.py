@@ -0,0 +1,272 @@
+"""Benchmark the upload pipeline on synthetic exports.
+
+Generates realistic exports (the real column names, visa steps, pending
+arrival tasks, nationalities and landing dates) and times each stage of
+the pipeline separately:
+
+    python benchmark.py --rows 1000 10000 100000 500000 --output bench.json
+
+Every stage is timed --repeat times (the best run is reported), then run
+once more under tracemalloc for its peak Python/numpy allocation. The
+download is timed through the route, which builds the export in the job
+pool, so its memory run builds the export in this process instead. The
+result is JSON, written to --output or printed.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import pipeline
+
+# Snapshots, exports, caches and job files of a run go to a scratch
+# directory. main() sets them in the environment before importing the app
+# (and with it jobs, and the job pool workers), and points the already
+# imported pipeline at the scratch snapshot directory.
+WORK_DIRS = ("UPLOAD_DIR", "SNAPSHOT_DIR", "EXPORT_DIR", "JOB_DIR", "SHARED_CACHE_DIR")
+
+VISA_STEPS = [
+    'Pending maid to go for EID Biometrics; ' + pipeline.MEDICAL_STEP,
+    pipeline.MEDICAL_STEP,
+    'EID fingerprinting pending',
+    'Prepare EID application',
+    'Apply for entry Visa',
+    'Create Regular Offer Letter',
+    'Waiting for the PRO Update',
+    'Pending to fix MOHRE issue',
+    'Waiting for the maid to arrive',
+    'Visa issued',
+]
+PENDING_TASKS = ['STAND_UP_SHOOTING', 'MATCHING TYPES AND DATA GATHERING', 'TAWJEEH_TRAINING',
+                 'ORIENTATION', 'UPLOAD_CERTIFICATE', 'MAID_INFO', 'VIDEO_EDITING', 'NONE']
+NATIONALITIES = ['Filipina', 'Ethiopian', 'Ugandan', 'Kenyan', 'Indian', 'Sri Lankan', 'Nepalese']
+LIVE_OUT_TYPES = ['CC', 'CC (Live out)', ' CC ']
+VISA_TYPES = ['Entry Visa', 'Tourist Visa']
+FIRST_NAMES = ['Maria', 'Grace', 'Joy', 'Mary', 'Aster', 'Tigist', 'Sarah', 'Faith', 'Ruth',
+               'Hanna', 'Rose', 'Esther', 'Liza', 'Mercy', 'Almaz', 'Jane']
+LAST_NAMES = ['Santos', 'Reyes', 'Cruz', 'Bautista', 'Tesfaye', 'Girma', 'Namusoke', 'Achieng',
+              'Wanjiru', 'Nakato', 'Garcia', 'Mendoza', 'Bekele', 'Otieno', 'Kato', 'Dela Cruz']
+SIZES = [1000, 10000, 100000, 500000]
+
+
+def _pick(rng, values, n, missing=0.0):
+    """Random choice from values, with a share of missing entries"""
+    picked = rng.choice(np.array(values, dtype=object), n)
+    if missing:
+        picked[rng.random(n) < missing] = None
+    return picked
+
+
+def generate_export(rows, seed=0):
+    """A synthetic daily export with the columns and values the app expects"""
+    rng = np.random.default_rng(seed)
+    today = pipeline.reference_now().replace(tzinfo=None).normalize()
+    names = (_pick(rng, FIRST_NAMES, rows) + ' ' + _pick(rng, FIRST_NAMES, rows) + ' ' +
+             _pick(rng, LAST_NAMES, rows))
+    nationality = _pick(rng, NATIONALITIES, rows, missing=0.01)
+    gcc = _pick(rng, ['Yes', 'No'], rows)
+    gcc_date = np.where(rng.random(rows) < 0.5,
+                        (today - pd.to_timedelta(rng.integers(0, 60, rows), unit='D')).strftime('%Y-%m-%d'),
+                        None)
+    landed = today - pd.to_timedelta(rng.integers(0, 20, rows), unit='D')
+    landed = landed.where(rng.random(rows) >= 0.05)
+    return pd.DataFrame({
+        'Housemaid Id': np.arange(100000, 100000 + rows),
+        'Housemaid Name': names,
+        'Nationality': nationality,
+        'Current Visa Step': _pick(rng, VISA_STEPS, rows, missing=0.02),
+        'pending arrival task': _pick(rng, PENDING_TASKS, rows, missing=0.05),
+        'GCC': gcc,
+        'GCC Application Reference Number Upload Date': gcc_date,
+        'Live out type': _pick(rng, LIVE_OUT_TYPES, rows, missing=0.02),
+        'Landed In Dubai': landed,
+        'Type of Visa': _pick(rng, VISA_TYPES, rows, missing=0.02),
+    })
+
+
+def next_day_export(df, changed=0.05, seed=1):
+    """A later export of the same staff: some visa steps moved, a few rows added and removed"""
+    rng = np.random.default_rng(seed)
+    out = df.copy()
+    moved = rng.random(len(out)) < changed
+    out.loc[moved, 'Current Visa Step'] = _pick(rng, VISA_STEPS, int(moved.sum()))
+    turnover = max(1, len(out) // 100)
+    added = generate_export(turnover, seed=seed + 1)
+    added['Housemaid Id'] += len(df) + 1000000
+    return pd.concat([out.iloc[turnover:], added], ignore_index=True)
+
+
+def to_upload(df, fmt):
+    """The dcc.Upload contents string and filename for an export"""
+    buffer = io.BytesIO()
+    if fmt == 'csv':
+        df.to_csv(buffer, index=False)
+        mime = 'text/csv'
+    else:
+        # Not constant_memory: to_excel writes column by column, which that
+        # mode silently drops
+        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
+            df.to_excel(writer, index=False)
+        mime = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    data = buffer.getvalue()
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}", f"export.{fmt}", len(data)
+
+
+def measure(fn, repeat, trace_memory, memory_fn=None):
+    """Best wall time over repeat runs, plus the peak traced allocation of one more run
+
+    memory_fn, if given, is run for the memory instead of fn, for stages
+    whose work fn hands to another process.
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    result = {'seconds': min(runs), 'runs': runs}
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            (memory_fn or fn)()
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def max_rss_mb():
+    """Peak resident memory of this process so far"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def benchmark_size(rows, args, app):
+    """Time every stage on an export of the given size"""
+    df1 = generate_export(rows, seed=args.seed)
+    df2 = next_day_export(df1, seed=args.seed + 1)
+    contents, filename, upload_bytes = to_upload(df1, args.input_format)
+    contents2, _, _ = to_upload(df2, args.input_format)
+    df, error = pipeline.parse_contents(contents, filename)
+    if error:
+        raise RuntimeError(error)
+    df_next, error = pipeline.parse_contents(contents2, filename)
+    if error:
+        raise RuntimeError(error)
+    membership = pipeline.categorize(df)
+
+    # The export is uploaded and processed the way the dashboard does it:
+    # posted to /upload, then run through the analytics job. The download
+    # route then rebuilds the export from the staged file in the job pool.
+    client = app.server.test_client()
+    response = client.post('/upload', data={'file': (io.BytesIO(pipeline.decode_contents(contents)), filename)},
+                           content_type='multipart/form-data')
+    if response.status_code != 200:
+        raise RuntimeError(f"upload returned {response.status_code}")
+    token = response.get_json()['token']
+    result = app.wait_for_job(app.submit_job(app.analytics_job, token, filename))
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    app.accept_analytics_result(result)
+    # Let the export prebuilt by accept_analytics_result finish first
+    app.wait_for_job(app.submit_job(app.export_job, token, 'xlsx', filename))
+
+    def download():
+        path = app.export_path(token, args.export_format)
+        if os.path.exists(path):
+            os.remove(path)
+        response = client.get(f"/download/{token}/{args.export_format}")
+        response.get_data()
+        response.close()
+        if response.status_code != 200:
+            raise RuntimeError(f"download returned {response.status_code}")
+
+    def export_in_process():
+        path = app.export_path(token, args.export_format)
+        if os.path.exists(path):
+            os.remove(path)
+        result = app.export_job(None, token, args.export_format, filename)
+        if 'error' in result:
+            raise RuntimeError(result['error'])
+
+    stages = {
+        'parse_contents': lambda: pipeline.parse_contents(contents, filename),
+        'process_data': lambda: pipeline.process_data(df),
+        'analytics': lambda: pipeline.compute_analytics(df, membership),
+        'download_excel': download,
+        'compare_files': lambda: pipeline.compare_frames(df, df_next, 'matches', fuzzy=args.fuzzy),
+    }
+    # The route waits on the job pool, so its own memory would show nothing
+    # of the export; peak_mb and max_rss_mb count the in-process build
+    memory_fns = {'download_excel': export_in_process}
+    result = {'upload_bytes': upload_bytes, 'stages': {}}
+    for name, fn in stages.items():
+        result['stages'][name] = measure(fn, args.repeat, not args.no_memory, memory_fns.get(name))
+        print(f"{rows:>8,} rows  {name:<15} {result['stages'][name]['seconds']:8.3f}s",
+              file=sys.stderr)
+    result['max_rss_mb'] = max_rss_mb()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=SIZES,
+                        help="export sizes to benchmark (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage")
+    parser.add_argument('--input-format', choices=['xlsx', 'csv'], default='xlsx')
+    parser.add_argument('--export-format', choices=sorted(pipeline.EXPORT_FORMATS), default='xlsx')
+    parser.add_argument('--fuzzy', action='store_true', help="use fuzzy name matching in compare_files")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {
+        'created': pd.Timestamp.now(tz='UTC').isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': {'pandas': pd.__version__, 'numpy': np.__version__,
+                     'pyarrow': pipeline.pa.__version__ if pipeline.pa is not None else None},
+        'excel_engine': pipeline.EXCEL_ENGINE or 'openpyxl',
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': {},
+    }
+    work_dir = tempfile.mkdtemp(prefix="preavailable-bench-")
+    try:
+        for name in WORK_DIRS:
+            os.environ[name] = os.path.join(work_dir, name.lower())
+        pipeline.SNAPSHOT_DIR = os.environ["SNAPSHOT_DIR"]
+        import app
+        for rows in args.rows:
+            report['results'][str(rows)] = benchmark_size(rows, args, app)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
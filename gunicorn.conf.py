@@ -0,0 +1,32 @@
+# Production settings for serving the dashboard with gunicorn:
+#
+#     gunicorn app:server
+#
+# gunicorn reads this file from the working directory. Every value can be
+# overridden with the environment variables below.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8050)}"
+
+# Worker processes, each handling requests on a small thread pool. Parsed
+# uploads, result tables and job state are shared through files on disk, so
+# any worker can answer any request.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * (os.cpu_count() or 1) + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+
+# Import the app once in the master before forking the workers
+preload_app = True
+
+# Large uploads and exports can take a while; give in-flight requests time
+# to finish on a graceful restart (SIGHUP) or shutdown (SIGTERM)
+timeout = int(os.environ.get("WEB_TIMEOUT", 300))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 60))
+keepalive = 5
+
+# Recycle workers periodically to bound memory growth from cached frames
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("WEB_MAX_REQUESTS_JITTER", 100))
+
+accesslog = "-"
+errorlog = "-"
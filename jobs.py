@@ -0,0 +1,500 @@
+"""Background jobs and upload storage for the dashboard.
+
+The web process stages uploads in UPLOAD_DIR and runs the jobs below on a
+spawn process pool. They are kept out of app.py so pool workers import only
+this module and pipeline, not Dash and the layout, and out of pipeline so it
+stays the headless processing library. Progress, cancellation and results
+go through small files in JOB_DIR, so any WSGI worker can report on a job
+another one started.
+"""
+import cProfile
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
+from pipeline import (
+    timed, reload_rules, rules_version, read_workbook, read_workbook_chunks, schema_report,
+    required_columns, load_snapshot, save_snapshot, snapshot_path, mark_uploaded,
+    previous_upload, align_uploads, categorize_incremental, upload_changes, get_membership,
+    get_categories, get_analytics, EXPORT_FORMATS, write_excel_export, write_zip_export,
+    category_writer, compare_frames, comparison_index, save_history, ingest_history,
+    reference_now, summary_counts, combine_summaries, breach_forecast, ALERT_TABLES,
+    STREAM_FORMATS, analyze_chunks,
+)
+
+# Job results and shared cache entries are pickles, so JOB_DIR and
+# SHARED_CACHE_DIR default to per-user directories that private_dir()
+# creates with mode 0700 and refuses to use if another user owns them.
+def _private_default(name):
+    """Default per-user location of a directory that holds pickles"""
+    owner = f"-{os.getuid()}" if hasattr(os, 'getuid') else ""
+    return os.path.join(tempfile.gettempdir(), f"preavailable-{name}{owner}")
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "preavailable-uploads"))
+UPLOAD_RETENTION_SECONDS = int(os.environ.get("UPLOAD_RETENTION_HOURS", 24)) * 3600
+EXPORT_DIR = os.environ.get("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "preavailable-exports"))
+SHARED_CACHE_DIR = os.environ.get("SHARED_CACHE_DIR", _private_default("cache"))
+JOB_DIR = os.environ.get("JOB_DIR", _private_default("jobs"))
+HISTORY_WORKERS = int(os.environ.get("HISTORY_WORKERS", os.cpu_count() or 2))
+_private_dirs = set()
+
+def private_dir(path):
+    """Create a directory only this user can access, refusing one owned by another user"""
+    if path in _private_dirs:
+        return path
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        info = os.stat(path)
+        if info.st_uid != os.getuid():
+            raise RuntimeError(f"{path} is owned by another user; point it at a private directory")
+        if info.st_mode & 0o077:
+            os.chmod(path, 0o700)
+    _private_dirs.add(path)
+    return path
+
+def streamed_upload_path(token):
+    """Location on disk of a file received by the /upload endpoint"""
+    return os.path.join(UPLOAD_DIR, f"{token}.upload")
+
+def remove_expired_files(directory):
+    """Delete streamed uploads, exports or cached tables older than the retention period"""
+    cutoff = time.time() - UPLOAD_RETENTION_SECONDS
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def read_streamed_upload(token, filename, use='analytics'):
+    """Read a file saved by the /upload endpoint (or staged by the dashboard)"""
+    path = streamed_upload_path(token)
+    if not os.path.exists(path):
+        return None, "The uploaded file has expired, please upload it again."
+    return read_workbook(path, filename, use)
+
+def read_upload_entry(token, filename, read, previous=None):
+    """Load an upload from its snapshot, or read() it and write the snapshot
+
+    With a previous upload, a newly read file is categorized incrementally
+    and the entry carries the row alignment under 'alignment'.
+    """
+    entry = load_snapshot(token)
+    if entry is None:
+        df, error = read()
+        if error:
+            return None, error
+        entry = {'filename': filename, 'df': df, 'categories': None, 'membership': None}
+        if previous is not None:
+            entry['alignment'] = align_uploads(previous, df)
+            entry['membership'] = categorize_incremental(df, previous, entry['alignment'])
+            entry['rules'] = rules_version()
+        save_snapshot(token, entry)
+    elif previous is not None:
+        entry['alignment'] = align_uploads(previous, entry['df'])
+    return entry, None
+
+def _shared_path(key):
+    """File in the shared cache directory holding the value for a key"""
+    return os.path.join(private_dir(SHARED_CACHE_DIR), hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+def shared_put(key, value):
+    """Write a value to the cross-worker disk cache"""
+    path = _shared_path(key)
+    remove_expired_files(SHARED_CACHE_DIR)
+    fd, tmp_path = tempfile.mkstemp(dir=SHARED_CACHE_DIR, suffix='.part')
+    with os.fdopen(fd, 'wb') as out:
+        pickle.dump(value, out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def shared_get(key):
+    """Read a value from the cross-worker disk cache, or None"""
+    try:
+        with open(_shared_path(key), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+def export_path(token, fmt):
+    """Where the export of an upload in a given format is kept"""
+    suffix, _ = EXPORT_FORMATS[fmt]
+    return os.path.join(EXPORT_DIR, f"{token}_{rules_version()}{suffix}")
+
+def build_export(token, entry, fmt):
+    """Path to the export of an upload in the given format, building it once"""
+    path = export_path(token, fmt)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    remove_expired_files(EXPORT_DIR)
+    categories = get_categories(entry)
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_DIR, suffix='.part')
+    os.close(fd)
+    with timed(f'export.{fmt}', rows=len(entry['df'])) as sample:
+        if fmt == 'xlsx':
+            write_excel_export(entry['df'], categories, tmp_path)
+        else:
+            write_zip_export(entry['df'], categories, tmp_path, fmt)
+        sample['bytes'] = os.path.getsize(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+class JobCancelled(Exception):
+    """Raised inside a job when the user has cancelled it"""
+
+def job_file(job_id, kind):
+    """Path of a job's progress, cancel or result file"""
+    return os.path.join(private_dir(JOB_DIR), f"{job_id}.{kind}")
+
+def _write_job_file(job_id, kind, write):
+    """Atomically replace one of a job's files"""
+    path = job_file(job_id, kind)
+    fd, tmp_path = tempfile.mkstemp(dir=JOB_DIR, suffix='.part')
+    with os.fdopen(fd, 'wb') as out:
+        write(out)
+    os.replace(tmp_path, path)
+
+def run_job(fn, job_id, *args, profile_dir=None):
+    """Pool worker entry point: run a job and leave its result in JOB_DIR
+
+    With profile_dir (set for jobs started by a profiled request), the job
+    runs under cProfile and its stats are dumped to that directory.
+    """
+    reload_rules()
+    profiler = cProfile.Profile() if profile_dir else None
+    try:
+        with timed(f"job.{fn.__name__}"):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = fn(job_id, *args)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    except Exception as error:
+        result = {'error': str(error) or type(error).__name__}
+    if profiler is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(
+            profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}_job.{fn.__name__}_{job_id[:6]}.prof"))
+    _write_job_file(job_id, 'result',
+                    lambda out: pickle.dump(result, out, protocol=pickle.HIGHEST_PROTOCOL))
+
+def report_progress(job_id, percent, stage):
+    """Record a job's progress from inside the worker, stopping if cancelled"""
+    if os.path.exists(job_file(job_id, 'cancel')):
+        raise JobCancelled()
+    _write_job_file(job_id, 'progress',
+                    lambda out: out.write(json.dumps({'percent': percent, 'stage': stage}).encode()))
+
+def analytics_job(job_id, token, filename):
+    """Background job: parse, categorize and compute analytics (large uploads also get their export)"""
+    try:
+        report_progress(job_id, 5, "Reading file")
+        if streams_upload(token):
+            analytics, error = stream_upload(
+                token, filename, 'xlsx',
+                lambda rows: report_progress(job_id, 50, f"Processed {rows:,} rows"))
+            if error:
+                return {'error': error}
+            entry = {'filename': filename, 'df': None, 'categories': None, 'membership': None,
+                     'analytics': analytics}
+            # No snapshot to reopen it from, so other web workers find it here
+            shared_put(f"streamed:{token}", entry)
+            report_progress(job_id, 100, "Done")
+            return {'token': token, 'entry': entry}
+        with timed('upload.previous'):
+            previous = previous_upload(token)
+        with timed('upload.read') as sample:
+            entry, error = read_upload_entry(token, filename,
+                                             lambda: read_streamed_upload(token, filename),
+                                             previous)
+            if error:
+                return {'error': error}
+            sample['rows'] = len(entry['df'])
+        if filename is not None and entry.get('uploaded') is not None:
+            # A file uploaded again (not reopened from the list) is the latest upload
+            mark_uploaded(token)
+        # A snapshot of a file uploaded for comparison may lack analytics columns
+        error = schema_report(entry['df'].columns, required_columns())
+        if error:
+            return {'error': error}
+        report_progress(job_id, 50, "Categorizing rows")
+        get_membership(entry)
+        if previous is not None:
+            with timed('upload.diff', rows=len(entry['df'])):
+                shared_put(f"table:{token}:changes",
+                           upload_changes(previous, entry, entry.pop('alignment')))
+        report_progress(job_id, 65, "Computing visa alerts")
+        get_analytics(entry)
+        report_progress(job_id, 100, "Done")
+    except JobCancelled:
+        return {'error': "Processing was cancelled."}
+    # Category frames are cheap to rebuild from the bitmask, so they are not
+    # sent back to the web process
+    entry['categories'] = None
+    return {'token': token, 'entry': entry}
+
+def export_job(job_id, token, fmt, filename=None):
+    """Background job: build an export with every column of an upload
+
+    The staged file is read again in full (a chunk at a time for large
+    uploads). Once it has expired, the export is built from the snapshot,
+    which holds only the columns loaded for analytics.
+    """
+    path = export_path(token, fmt)
+    if os.path.exists(path):
+        return {'path': path}
+    if filename is not None and streams_upload(token):
+        if fmt not in STREAM_FORMATS:
+            return {'error': f"Large uploads export as {' or '.join(STREAM_FORMATS)} only."}
+        analytics, error = stream_upload(token, filename, fmt)
+        if error:
+            return {'error': error}
+        return {'path': path}
+    if filename is not None and os.path.exists(streamed_upload_path(token)):
+        df, error = read_streamed_upload(token, filename, 'export')
+        if error:
+            return {'error': error}
+        entry = {'filename': filename, 'df': df, 'categories': None, 'membership': None}
+    else:
+        entry = load_snapshot(token)
+        if entry is None:
+            return {'error': "That upload is no longer available."}
+    return {'path': build_export(token, entry, fmt)}
+
+def compare_job(job_id, token1, filename1, token2, filename2, mode, fuzzy, threshold):
+    """Background job: load both uploads and compare their names"""
+    try:
+        report_progress(job_id, 5, "Reading first file")
+        with timed('upload.read'):
+            entry1, error1 = read_upload_entry(token1, filename1,
+                                               lambda: read_streamed_upload(token1, filename1,
+                                                                            'comparison'))
+        if error1:
+            return {'error1': error1}
+        report_progress(job_id, 35, "Reading second file")
+        with timed('upload.read'):
+            entry2, error2 = read_upload_entry(token2, filename2,
+                                               lambda: read_streamed_upload(token2, filename2,
+                                                                            'comparison'))
+        if error2:
+            return {'error2': error2}
+        
+        # Both files passed the comparison header check in read_workbook
+        df1, df2 = entry1['df'], entry2['df']
+        
+        report_progress(job_id, 65, "Matching names")
+        with timed('compare.match', rows=len(df1) + len(df2)):
+            frame = compare_frames(df1, df2, mode, fuzzy=fuzzy, threshold=threshold,
+                                   right_index=comparison_index(df2, token2) if fuzzy else None)
+        report_progress(job_id, 100, "Done")
+    except JobCancelled:
+        return {'error': "Comparison was cancelled."}
+    return {'frame': frame}
+
+def history_job(job_id, sources):
+    """Background job: add (token, filename, date) uploads to the history store"""
+    try:
+        report_progress(job_id, 0, f"Reading {len(sources)} exports")
+        files, results = [], []
+        for token, filename, date in sources:
+            path = streamed_upload_path(token)
+            if os.path.exists(path):
+                files.append((path, filename, date))
+                continue
+            # Already snapshotted, so the staged file was not kept
+            entry = load_snapshot(token)
+            if entry is None:
+                error = "The upload has expired, please upload it again."
+            else:
+                error = schema_report(entry['df'].columns, required_columns())
+            if error:
+                results.append({'file': filename, 'error': error})
+            else:
+                save_history(date, entry['df'], get_membership(entry), filename)
+                results.append({'file': filename, 'date': date, 'rows': len(entry['df'])})
+        results += ingest_history(
+            files, HISTORY_WORKERS,
+            lambda done, total: report_progress(job_id, int(100 * done / total),
+                                                f"Filed {done} of {total} exports"))
+    except JobCancelled:
+        return {'error': "History upload was cancelled."}
+    return {'files': sorted(results, key=lambda result: result.get('date') or '')}
+
+# Dashboard uploads of STREAM_UPLOAD_MB or more are processed the same way,
+# so the job never holds their rows: the summary, the alert tables and the
+# xlsx export are built chunk by chunk, and the cached entry carries the
+# analytics without a frame. These uploads are not snapshotted, so they
+# cannot be reopened from the snapshot list, diffed against the previous
+# upload or filed into the history from a snapshot, and they export as xlsx
+# or csv only. Name comparisons still read both files whole.
+STREAM_UPLOAD_MB = float(os.environ.get("STREAM_UPLOAD_MB", 25))
+
+def streams_upload(token):
+    """Whether a staged upload is large enough to be processed a chunk at a time"""
+    path = streamed_upload_path(token)
+    return (os.path.exists(path) and snapshot_path(token) is None
+            and os.path.getsize(path) >= STREAM_UPLOAD_MB * 1024 * 1024)
+
+def stream_upload(token, filename, fmt='xlsx', progress=None):
+    """Write the export of a staged upload a chunk at a time and return its analytics
+
+    progress(rows), when given, is called after each chunk.
+    """
+    path = streamed_upload_path(token)
+    if not os.path.exists(path):
+        return None, "The uploaded file has expired, please upload it again."
+    chunks, error = read_workbook_chunks(path, filename, use='export')
+    if error:
+        return None, error
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    remove_expired_files(EXPORT_DIR)
+    fd, tmp_path = tempfile.mkstemp(dir=EXPORT_DIR, suffix='.part')
+    os.close(fd)
+    now = reference_now()
+    alerts = {name: [] for name in ALERT_TABLES}
+    summary, date_failures, rows = None, 0, 0
+    try:
+        with timed(f'export.{fmt}') as sample, category_writer(tmp_path, fmt) as append:
+            for chunk_rows, analytics in analyze_chunks(chunks, append, now, 'upload.chunk'):
+                for name in ALERT_TABLES:
+                    alerts[name].append(analytics[name])
+                summary = (analytics['summary'] if summary is None
+                           else combine_summaries([summary, analytics['summary']]))
+                date_failures += analytics['date_failures']
+                rows += chunk_rows
+                if progress is not None:
+                    progress(rows)
+            sample['rows'] = rows
+        if summary is None:
+            os.remove(tmp_path)
+            return None, "The file has no data rows."
+        os.replace(tmp_path, export_path(token, fmt))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    # Chunks are in file order; sort the alert tables as compute_analytics does
+    visa_alerts = pd.concat(alerts['visa_alerts'], ignore_index=True)
+    at_risk = pd.concat(alerts['at_risk'], ignore_index=True)
+    return {
+        'config': analytics['config'],
+        'as_of': analytics['as_of'],
+        **summary_counts(summary),
+        'summary': summary,
+        'date_failures': date_failures,
+        'forecast': breach_forecast(summary),
+        'visa_alerts': visa_alerts.sort_values('Days Since Landing', ascending=False, kind='stable'),
+        'at_risk': at_risk.sort_values('Days Until Breach', kind='stable'),
+    }, None
+
+# The pool. Jobs run on a local spawn process pool so one large upload does
+# not block other users; the browser polls job_status() for the result.
+#
+# Every WSGI worker has its own pool, so JOB_WORKERS is per web worker:
+# gunicorn's default of 2 * cores + 1 web workers already gives more job
+# processes than cores with one each. A job process that dies (an OOM kill,
+# say) breaks its pool for good, so a broken pool is replaced on the next
+# submit and the jobs it held are reported as failed.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 1))
+_job_pool = None
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+def submit_job(fn, *args, profile_dir=None):
+    """Run fn(job_id, *args) on the process pool and return the job id"""
+    global _job_pool
+    remove_expired_files(private_dir(JOB_DIR))
+    job_id = uuid.uuid4().hex
+    report_progress(job_id, 0, "Waiting for a free worker")
+    with _jobs_lock:
+        for attempt in range(2):
+            if _job_pool is None:
+                _job_pool = ProcessPoolExecutor(max_workers=JOB_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+            try:
+                _jobs[job_id] = _job_pool.submit(run_job, fn, job_id, *args, profile_dir=profile_dir)
+                break
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+                _job_pool.shutdown(wait=False)
+                _job_pool = None
+    return job_id
+
+def job_status(job_id):
+    """State of a job: running (with progress), done (with result) or missing"""
+    with _jobs_lock:
+        future = _jobs.get(job_id)
+    if future is not None and future.cancelled():
+        return {'state': 'done', 'result': {'error': "Processing was cancelled."}}
+    try:
+        with open(job_file(job_id, 'result'), 'rb') as f:
+            return {'state': 'done', 'result': pickle.load(f)}
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+    if future is not None and future.done():
+        # The worker process died before writing a result
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            error = "The job stopped unexpectedly, possibly because it ran out of memory. Please try again."
+        return {'state': 'done', 'result': {'error': str(error) or type(error).__name__}}
+    try:
+        with open(job_file(job_id, 'progress')) as f:
+            return {'state': 'running', **json.load(f)}
+    except OSError:
+        return {'state': 'missing'}
+    except ValueError:
+        return {'state': 'running', 'percent': 0, 'stage': "Waiting for a free worker"}
+
+def cancel_job(job_id):
+    """Ask a job to stop at its next progress report"""
+    with _jobs_lock:
+        future = _jobs.get(job_id)
+    if future is not None and future.cancel():
+        return
+    open(job_file(job_id, 'cancel'), 'w').close()
+
+def forget_job(job_id):
+    """Drop a finished job and its files"""
+    with _jobs_lock:
+        _jobs.pop(job_id, None)
+    for kind in ('progress', 'cancel', 'result'):
+        try:
+            os.remove(job_file(job_id, kind))
+        except OSError:
+            pass
+
+def wait_for_job(job_id):
+    """Block until a job finishes and return its result"""
+    with _jobs_lock:
+        future = _jobs[job_id]
+    try:
+        future.result()
+    except Exception:
+        pass
+    result = job_status(job_id)['result']
+    forget_job(job_id)
+    return result
+
+def prebuild_export(token, filename, profile_dir=None):
+    """Start building an upload's xlsx export in the background, so the download is ready"""
+    if os.path.exists(export_path(token, 'xlsx')):
+        return
+    job_id = submit_job(export_job, token, 'xlsx', filename, profile_dir=profile_dir)
+    with _jobs_lock:
+        future = _jobs[job_id]
+    # Nobody polls this job, so drop it once it is done
+    future.add_done_callback(lambda future: forget_job(job_id))
@@ -0,0 +1,1970 @@
+"""Headless processing pipeline for the visa-step exports.
+
+Ingest -> categorize -> alerts -> export -> compare, without Dash, Plotly or
+Flask. The dashboard in app.py is built on these functions, and nightly
+reports can import them directly or run the batch mode:
+
+    python pipeline.py INPUT_DIR OUTPUT_DIR --workers 4
+
+Each export in INPUT_DIR gets a processed workbook (one sheet per
+category), its visa alert and at-risk tables and a JSON summary. With
+--stream, exports are read and written in chunks so memory stays bounded
+for very large files. The dashboard's upload storage and background jobs
+are in jobs.py, built on these functions.
+"""
+import io
+import re
+import base64
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from functools import lru_cache
+import argparse
+import difflib
+import hashlib
+import itertools
+import unicodedata
+import threading
+import tempfile
+import time
+import os
+import shutil
+import sys
+import importlib.util
+import json
+import logging
+import tracemalloc
+from contextlib import contextmanager
+import uuid
+import zipfile
+import pandas as pd
+import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # snapshots are disabled without pyarrow
+    pa = feather = None
+try:
+    import fcntl
+except ImportError:  # metrics of exited processes are not folded without fcntl
+    fcntl = None
+
+# Instrumentation. Hot-path stages run inside timed(), which records wall
+# time, rows, payload bytes and (with METRICS_TRACE_MEMORY=1) the peak traced
+# allocation. Each process, including job and batch workers, keeps its
+# totals in a JSON file in METRICS_DIR named by its PID and a random suffix,
+# so a reused PID never overwrites an exited process's totals. Every sample
+# is also logged as one JSON line. metrics_totals() folds the files of
+# exited processes into METRICS_ROLLUP and deletes them, so the directory
+# holds one file per live process plus the rollup.
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "preavailable-metrics"))
+METRICS_ROLLUP = "rollup.json"
+METRICS_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+METRICS_TRACE_MEMORY = os.environ.get("METRICS_TRACE_MEMORY", "0") == "1"
+metrics_log = logging.getLogger("preavailable.metrics")
+if os.environ.get("METRICS_LOG", "1") == "1" and not metrics_log.handlers:
+    metrics_log.addHandler(logging.StreamHandler())
+    metrics_log.setLevel(logging.INFO)
+    metrics_log.propagate = False
+_metrics = {}
+_metrics_file = {'pid': None, 'path': None}
+_metrics_lock = threading.Lock()
+_metrics_stack = threading.local()
+
+def _empty_stage():
+    """Zeroed totals for one stage"""
+    return {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0,
+            'peak_bytes': 0, 'buckets': [0] * len(METRICS_BUCKETS)}
+
+def record_stage(stage, seconds, rows=None, nbytes=None, peak_bytes=None):
+    """Add one timing sample for a stage to this process's metrics"""
+    with _metrics_lock:
+        if _metrics_file['pid'] != os.getpid():
+            # A forked worker starts from zero; the parent's file keeps its own totals
+            _metrics.clear()
+            _metrics_file['pid'] = os.getpid()
+            _metrics_file['path'] = os.path.join(METRICS_DIR, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        m = _metrics.setdefault(stage, _empty_stage())
+        m['count'] += 1
+        m['seconds'] += seconds
+        m['rows'] += rows or 0
+        m['bytes'] += nbytes or 0
+        m['peak_bytes'] = max(m['peak_bytes'], peak_bytes or 0)
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                m['buckets'][i] += 1
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.part')
+            with os.fdopen(fd, 'w') as out:
+                json.dump(_metrics, out)
+            os.replace(tmp_path, _metrics_file['path'])
+        except OSError:
+            pass
+    metrics_log.info(json.dumps({'stage': stage, 'seconds': round(seconds, 6), 'rows': rows,
+                                 'bytes': nbytes, 'peak_bytes': peak_bytes, 'pid': os.getpid()}))
+
+def _add_metrics(totals, stages):
+    """Add one process's stage totals into totals"""
+    for stage, m in stages.items():
+        total = totals.setdefault(stage, _empty_stage())
+        for key in ('count', 'seconds', 'rows', 'bytes'):
+            total[key] += m[key]
+        total['peak_bytes'] = max(total['peak_bytes'], m['peak_bytes'])
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], m['buckets'])]
+
+def _read_metrics(path):
+    """Stage totals from a metrics file, or None if it can't be read"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _process_exited(name):
+    """Whether the process that wrote a metrics file has exited"""
+    try:
+        pid = int(name.split('.')[0].split('-')[0])
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, OSError):
+        pass
+    return False
+
+def metrics_totals():
+    """Stage totals of every process, folding the files of exited processes into the rollup"""
+    if not os.path.isdir(METRICS_DIR):
+        return {}
+    totals = {}
+    rollup_path = os.path.join(METRICS_DIR, METRICS_ROLLUP)
+    lock = open(os.path.join(METRICS_DIR, "rollup.lock"), 'a') if fcntl is not None else None
+    try:
+        if lock is not None:
+            # One scrape at a time folds, so no file is counted twice
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        rollup = _read_metrics(rollup_path) or {}
+        exited = []
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith('.json') or name == METRICS_ROLLUP:
+                continue
+            stages = _read_metrics(os.path.join(METRICS_DIR, name))
+            if stages is None:
+                continue
+            if lock is not None and _process_exited(name):
+                _add_metrics(rollup, stages)
+                exited.append(name)
+            else:
+                _add_metrics(totals, stages)
+        if exited:
+            fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix='.part')
+            with os.fdopen(fd, 'w') as out:
+                json.dump(rollup, out)
+            os.replace(tmp_path, rollup_path)
+            for name in exited:
+                os.remove(os.path.join(METRICS_DIR, name))
+        _add_metrics(totals, rollup)
+    finally:
+        if lock is not None:
+            lock.close()
+    return totals
+
+@contextmanager
+def timed(stage, rows=None, nbytes=None):
+    """Time a block as a stage; the yielded dict can set 'rows' and 'bytes'"""
+    sample = {'rows': rows, 'bytes': nbytes}
+    tracing = METRICS_TRACE_MEMORY and tracemalloc.is_tracing()
+    stack = _metrics_stack.__dict__.setdefault('peaks', [])
+    if tracing:
+        # Peaks are reset per stage; an enclosing stage keeps the larger one
+        if stack:
+            stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        stack.append(0)
+    start = time.perf_counter()
+    try:
+        yield sample
+    finally:
+        seconds = time.perf_counter() - start
+        peak = None
+        if tracing:
+            peak = max(stack.pop(), tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+        record_stage(stage, seconds, sample['rows'], sample['bytes'], peak)
+
+if METRICS_TRACE_MEMORY:
+    tracemalloc.start()
+
+# Columns the dashboard uses. Only these are read for analytics, and
+# low-cardinality ones are loaded as categoricals. Exports are read again
+# with every column, so the processed download keeps the whole export. Set
+# INGEST_ALL_COLUMNS=1 to keep every column in the analytics frame too.
+TEXT_COLUMNS = ['Housemaid Id', 'Housemaid Name', 'GCC Application Reference Number Upload Date']
+CATEGORY_COLUMNS = ['Nationality', 'Type of Visa', 'Live out type', 'Current Visa Step',
+                    'pending arrival task', 'GCC']
+DATE_COLUMNS = ['Landed In Dubai']
+SCHEMA_COLUMNS = TEXT_COLUMNS + CATEGORY_COLUMNS + DATE_COLUMNS
+INGEST_ALL_COLUMNS = os.environ.get("INGEST_ALL_COLUMNS", "0") == "1"
+
+# calamine is a much faster xlsx reader than openpyxl; use it when installed
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else None
+
+# Before an upload is parsed, its header row is read on its own (a
+# read-only, streaming open for workbooks) and checked against the columns
+# the pipeline needs. A malformed export fails with the list of missing
+# columns instead of a KeyError after the full parse, and the full read
+# loads only the validated columns. What is required depends on the use:
+# analytics need the schema plus every column the category rules read, while
+# comparing two files needs only the columns compare_frames touches. Exports
+# are checked like analytics but load every column. Housemaid Id is
+# optional: uploads without it are categorized in full rather than
+# incrementally.
+OPTIONAL_COLUMNS = ['Housemaid Id']
+COMPARISON_COLUMNS = ['Housemaid Name', 'Current Visa Step', 'Live out type']
+
+def required_columns(use='analytics'):
+    """Columns an upload must have for a use ('analytics', 'export' or 'comparison')"""
+    if use == 'comparison':
+        return list(COMPARISON_COLUMNS)
+    required = [col for col in SCHEMA_COLUMNS if col not in OPTIONAL_COLUMNS]
+    return required + [col for col in _compiled_rules['columns'] if col not in required]
+
+def read_header(source, filename):
+    """Column names from the first row of an export, without reading the body"""
+    if filename.lower().endswith('.csv'):
+        header = list(pd.read_csv(source, nrows=0).columns)
+    else:
+        import openpyxl
+        # openpyxl judges a path by its extension; staged uploads end in .upload
+        handle = open(source, 'rb') if isinstance(source, (str, os.PathLike)) else source
+        try:
+            workbook = openpyxl.load_workbook(handle, read_only=True, data_only=True)
+            try:
+                header = list(next(workbook.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+            finally:
+                workbook.close()
+        finally:
+            if handle is not source:
+                handle.close()
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return [col for col in header if col is not None]
+
+def schema_report(header, required):
+    """Error message naming the required columns missing from a header, or None"""
+    present = {str(col).strip() for col in header}
+    missing = [col for col in required if col not in present]
+    if not present:
+        return "The file has no header row."
+    if not missing:
+        return None
+    # Point at near misses such as a different case or a typo
+    folded = {col.lower(): col for col in present}
+    details = []
+    for col in missing:
+        close = difflib.get_close_matches(col.lower(), folded, n=1, cutoff=0.8)
+        details.append(f"{col} (found '{folded[close[0]]}')" if close else col)
+    return f"Missing required columns: {', '.join(details)}."
+
+def validate_header(source, filename, use='analytics'):
+    """Columns to load from an export after checking its header, or an error"""
+    with timed('upload.header'):
+        header = read_header(source, filename)
+    required = required_columns(use)
+    error = schema_report(header, required)
+    if error:
+        return None, error
+    if INGEST_ALL_COLUMNS or use == 'export':
+        return None, None
+    wanted = set(SCHEMA_COLUMNS) | set(required)
+    return [col for col in header if str(col).strip() in wanted], None
+
+def apply_schema_dtypes(df):
+    """Convert schema columns to categoricals and parsed dates in place"""
+    df.columns = [str(col).strip() for col in df.columns]
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    failures = 0
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col], col_failures = parse_landing_dates(df[col])
+            failures += col_failures
+    df.attrs['date_parse_failures'] = failures
+    return df
+
+def read_workbook(source, filename, use='analytics'):
+    """Read an uploaded Excel or CSV export from a path or file-like object"""
+    name = filename.lower()
+    if not name.endswith('.csv') and 'xlsx' not in name:
+        return None, "Please upload an Excel or CSV file."
+    try:
+        usecols, error = validate_header(source, name, use)
+        if error:
+            return None, error
+        with timed('upload.parse') as sample:
+            if name.endswith('.csv'):
+                df = pd.read_csv(source, usecols=usecols,
+                                 dtype={col: 'category' for col in CATEGORY_COLUMNS})
+            else:
+                df = pd.read_excel(source, usecols=usecols, engine=EXCEL_ENGINE)
+            sample['rows'] = len(df)
+            
+        return apply_schema_dtypes(df), None
+    except Exception as e:
+        return None, str(e)
+
+# Exports too large to hold in memory can be read STREAM_CHUNK_ROWS rows at
+# a time instead (see stream_file)
+STREAM_CHUNK_ROWS = int(os.environ.get("STREAM_CHUNK_ROWS", 50000))
+
+def read_workbook_chunks(path, filename, chunk_rows=None, use='analytics'):
+    """Read an export from a path as typed frames of chunk_rows rows, in file order
+
+    Returns an iterator of frames and an error message, like read_workbook;
+    the header is validated before any rows are read.
+    """
+    chunk_rows = chunk_rows or STREAM_CHUNK_ROWS
+    name = filename.lower()
+    if not name.endswith('.csv') and 'xlsx' not in name:
+        return None, "Please upload an Excel or CSV file."
+    try:
+        usecols, error = validate_header(path, name, use)
+    except Exception as e:
+        return None, str(e)
+    if error:
+        return None, error
+    if name.endswith('.csv'):
+        chunks = pd.read_csv(path, usecols=usecols, chunksize=chunk_rows,
+                             dtype={col: 'category' for col in CATEGORY_COLUMNS})
+    else:
+        chunks = _excel_chunks(path, usecols, chunk_rows)
+    return (apply_schema_dtypes(chunk) for chunk in chunks), None
+
+def _excel_chunks(path, usecols, chunk_rows):
+    """Frames of chunk_rows rows from the first sheet, streamed by openpyxl"""
+    import openpyxl
+    with open(path, 'rb') as handle:
+        workbook = openpyxl.load_workbook(handle, read_only=True, data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = list(next(rows, ()))
+            keep = [i for i, col in enumerate(header)
+                    if col is not None and (usecols is None or col in usecols)]
+            while True:
+                block = list(itertools.islice(rows, chunk_rows))
+                if not block:
+                    return
+                # Blank rows are skipped, as read_excel does
+                values = [[row[i] if i < len(row) else None for i in keep]
+                          for row in block if any(value is not None for value in row)]
+                yield pd.DataFrame(values, columns=[header[i] for i in keep])
+        finally:
+            workbook.close()
+
+def decode_contents(contents):
+    """Decode a dcc.Upload data URI into the raw file bytes"""
+    content_type, content_string = contents.split(',')
+    with timed('upload.decode', nbytes=len(content_string)):
+        return base64.b64decode(content_string)
+
+def parse_contents(contents, filename):
+    """Parse uploaded Excel file contents"""
+    return read_workbook(io.BytesIO(decode_contents(contents)), filename)
+
+def get_membership(entry):
+    """Category bitmask per row of a cached upload, computed once per rule table"""
+    if entry['membership'] is None or entry.get('rules') != rules_version():
+        compiled = _compiled_rules
+        with timed('upload.categorize', rows=len(entry['df'])):
+            entry['membership'] = categorize(entry['df'], compiled)
+        entry['rules'] = compiled['fingerprint']
+        entry['categories'] = None
+    return entry['membership']
+
+def get_categories(entry):
+    """Row positions of each category of a cached upload, computed once"""
+    membership = get_membership(entry)
+    if entry['categories'] is None:
+        entry['categories'] = category_rows(membership)
+    return entry['categories']
+
+def analytics_current(analytics):
+    """Whether cached analytics were computed under today's date and the current config
+
+    Day counts, alerts and the forecast move with the date, so analytics
+    computed before midnight are stale after it.
+    """
+    return (analytics is not None and analytics['config'] == config_version()
+            and analytics.get('as_of') == reference_now().strftime('%Y-%m-%d'))
+
+def get_analytics(entry):
+    """Counts and alert tables of a cached upload, recomputed when the date or config changes"""
+    analytics = entry.get('analytics')
+    # Streamed uploads keep no frame; start_analytics_job reruns their job instead
+    if not analytics_current(analytics) and entry['df'] is not None:
+        with timed('analytics.compute', rows=len(entry['df'])):
+            analytics = entry['analytics'] = compute_analytics(entry['df'], get_membership(entry))
+    return analytics
+
+# Every processed upload is also written to disk as an uncompressed Arrow
+# (Feather v2) snapshot named <upload date>_<token>.arrow, holding the typed
+# frame plus its category bitmask. Reopening or re-comparing a past upload is
+# then one Arrow read instead of an Excel parse. The file is memory-mapped so
+# its bytes are not buffered on the heap, but to_pandas() still copies every
+# column into the frame. Frames Arrow cannot type (mixed-type object columns
+# kept by INGEST_ALL_COLUMNS) are not snapshotted. Snapshots are listed in
+# upload order, from the time stored in their metadata (restamped when the
+# same file is uploaded again). Reading one touches its mtime, and the least
+# recently used are removed beyond SNAPSHOT_MAX_COUNT files or
+# SNAPSHOT_MAX_MB on disk.
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "preavailable-snapshots"))
+SNAPSHOT_MAX_COUNT = int(os.environ.get("SNAPSHOT_MAX_COUNT", 90))
+SNAPSHOT_MAX_MB = int(os.environ.get("SNAPSHOT_MAX_MB", 2048))
+SNAPSHOT_MASK_COLUMN = '__category_mask__'
+snapshot_log = logging.getLogger("preavailable.snapshots")
+
+def _snapshot_files():
+    """Snapshot paths, most recently used first"""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    paths = [os.path.join(SNAPSHOT_DIR, name) for name in os.listdir(SNAPSHOT_DIR)
+             if name.endswith('.arrow')]
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+def snapshot_path(token):
+    """Existing snapshot file for a token, or None"""
+    for path in _snapshot_files():
+        if path.endswith(f"_{token}.arrow"):
+            return path
+    return None
+
+def save_snapshot(token, entry):
+    """Persist a processed upload as an Arrow snapshot"""
+    if feather is None:
+        return
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    frame = entry['df'].copy(deep=False)
+    frame[SNAPSHOT_MASK_COLUMN] = get_membership(entry)
+    try:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+    except pa.ArrowException as error:
+        snapshot_log.warning("Not snapshotting %s: %s", entry['filename'] or token, error)
+        return
+    meta = {
+        'filename': entry['filename'],
+        'rules': _compiled_rules['fingerprint'],
+        'date_parse_failures': entry['df'].attrs.get('date_parse_failures', 0),
+    }
+    _write_snapshot(token, table, meta)
+    prune_snapshots()
+
+def _write_snapshot(token, table, meta):
+    """Write a snapshot table stamped with the current upload time, replacing any older file"""
+    meta = {**meta, 'uploaded': reference_now().strftime('%Y-%m-%d'), 'uploaded_at': time.time()}
+    previous = snapshot_path(token)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b'preavailable': json.dumps(meta).encode()})
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix='.part')
+    os.close(fd)
+    with timed('snapshot.write', rows=table.num_rows):
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+    path = os.path.join(SNAPSHOT_DIR, f"{meta['uploaded']}_{token}.arrow")
+    os.replace(tmp_path, path)
+    if previous is not None and previous != path:
+        os.remove(previous)
+
+def mark_uploaded(token):
+    """Stamp an existing snapshot with the current upload time, for a file uploaded again"""
+    path = snapshot_path(token) if feather is not None else None
+    if path is None:
+        return
+    table = feather.read_table(path)
+    _write_snapshot(token, table, json.loads(table.schema.metadata[b'preavailable']))
+
+def load_snapshot(token):
+    """Read a snapshot back into a cache entry, or None if there is none"""
+    path = snapshot_path(token) if feather is not None else None
+    if path is None:
+        return None
+    with timed('snapshot.read') as sample:
+        table = feather.read_table(path, memory_map=True)
+        meta = json.loads(table.schema.metadata[b'preavailable'])
+        df = table.to_pandas()
+        sample['rows'] = len(df)
+    membership = df.pop(SNAPSHOT_MASK_COLUMN).to_numpy()
+    df.attrs['date_parse_failures'] = meta['date_parse_failures']
+    os.utime(path)
+    # Category masks from an older rule table are recomputed
+    if meta['rules'] != _compiled_rules['fingerprint']:
+        membership = None
+    return {'filename': meta['filename'], 'df': df, 'categories': None,
+            'membership': membership, 'rules': meta['rules'], 'uploaded': meta['uploaded']}
+
+def snapshot_metadata(path):
+    """Metadata stored with a snapshot, read from the file footer only"""
+    with pa.memory_map(path) as source:
+        schema = pa.ipc.open_file(source).schema
+    return json.loads(schema.metadata[b'preavailable'])
+
+def list_snapshots():
+    """Previous uploads available on disk, most recently uploaded first"""
+    if feather is None:
+        return []
+    snapshots = []
+    for path in _snapshot_files():
+        try:
+            meta = snapshot_metadata(path)
+        except Exception:
+            continue
+        token = os.path.basename(path)[:-len('.arrow')].split('_', 1)[1]
+        snapshots.append({'token': token, 'filename': meta['filename'], 'uploaded': meta['uploaded'],
+                          'uploaded_at': meta.get('uploaded_at', 0.0)})
+    # Older snapshots without an upload time sort last, in usage order
+    snapshots.sort(key=lambda snapshot: snapshot['uploaded_at'], reverse=True)
+    return snapshots
+
+def prune_snapshots():
+    """Remove the oldest snapshots beyond the count and size limits"""
+    total = 0
+    for i, path in enumerate(_snapshot_files()):
+        total += os.path.getsize(path)
+        if i >= SNAPSHOT_MAX_COUNT or total > SNAPSHOT_MAX_MB * 1024 * 1024:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+MEDICAL_STEP = 'Waiting for the maid to go to medical test and EID fingerprinting'
+
+def needs_gcc_application(df):
+    """Rows of GCC-required nationalities with no GCC application uploaded"""
+    return (
+        df['Nationality'].isin(['Ugandan', 'Kenyan']).to_numpy() &
+        (df['GCC'] == 'No').to_numpy() &
+        df['GCC Application Reference Number Upload Date'].isna().to_numpy()
+    )
+
+# Category rules, evaluated in order. A rule matches when its column contains
+# every one of its patterns (or its predicate is true) and the row is not
+# already in one of the categories listed under 'exclude'.
+CATEGORY_RULES = [
+    {'name': 'Push for medical and book bio', 'column': 'Current Visa Step',
+     'patterns': ['Pending maid to go for EID Biometrics', MEDICAL_STEP]},
+    {'name': 'Push for medical', 'column': 'Current Visa Step',
+     'patterns': [MEDICAL_STEP],
+     'exclude': ['Push for medical and book bio']},
+    {'name': 'Push to book bio appointment', 'column': 'Current Visa Step',
+     'patterns': ['EID fingerprinting'],
+     'exclude': ['Push for medical and book bio']},
+    {'name': 'As Aya to book Bio Appointment', 'column': 'Current Visa Step',
+     'patterns': ['Prepare EID application'],
+     'exclude': ['Push for medical and book bio', 'Push for medical', 'Push to book bio appointment']},
+    {'name': 'Apply Entry Visa', 'column': 'Current Visa Step',
+     'patterns': ['Apply for entry Visa']},
+    {'name': 'Create Offer Letter', 'column': 'Current Visa Step',
+     'patterns': ['Create Regular Offer Letter']},
+    {'name': 'Check Complaints', 'column': 'Current Visa Step',
+     'patterns': ['Waiting for the PRO Update|Pending to fix MOHRE issue']},
+    {'name': 'Coaches', 'column': 'pending arrival task',
+     'patterns': ['STAND_UP_SHOOTING|MATCHING TYPES AND DATA GATHERING']},
+    {'name': 'Onboarding', 'column': 'pending arrival task',
+     'patterns': ['TAWJEEH_TRAINING|ORIENTATION|UPLOAD_CERTIFICATE|MAID_INFO']},
+    {'name': 'Media', 'column': 'pending arrival task',
+     'patterns': ['VIDEO_EDITING']},
+    {'name': 'Apply for GCC', 'predicate': needs_gcc_application},
+]
+
+UNMATCHED_CATEGORY = 'Unmatched'
+
+def compile_rules(rules):
+    """Compile a rule table into per-column regexes and category bitmasks"""
+    category_bits = {rule['name']: 1 << i for i, rule in enumerate(rules)}
+    if len(category_bits) > 63:
+        raise ValueError("At most 63 category rules are supported")
+
+    # Every distinct (column, pattern) pair becomes one bit in that column's
+    # pattern mask, and each column gets a combined regex used as a prefilter.
+    columns = {}
+    compiled = []
+    for rule in rules:
+        required = 0
+        if 'column' in rule:
+            col = columns.setdefault(rule['column'], {'patterns': []})
+            for pattern in rule['patterns']:
+                if pattern not in col['patterns']:
+                    col['patterns'].append(pattern)
+                required |= 1 << col['patterns'].index(pattern)
+        exclude = 0
+        for name in rule.get('exclude', []):
+            exclude |= category_bits[name]
+        compiled.append({
+            'name': rule['name'],
+            'bit': category_bits[rule['name']],
+            'column': rule.get('column'),
+            'required': required,
+            'exclude': exclude,
+            'predicate': rule.get('predicate'),
+        })
+
+    for col in columns.values():
+        col['regexes'] = [re.compile(p) for p in col['patterns']]
+        col['combined'] = re.compile('|'.join(f'(?:{p})' for p in col['patterns']))
+
+    return {'columns': columns, 'rules': compiled}
+
+def rules_fingerprint(rules):
+    """Short hash identifying a rule table, stored with cached category masks"""
+    described = [(rule['name'], rule.get('column'), rule.get('patterns'), rule.get('exclude'),
+                  getattr(rule.get('predicate'), '__name__', None)) for rule in rules]
+    return hashlib.sha1(repr(described).encode()).hexdigest()[:16]
+
+# Days since landing after which a visa is flagged (alert) or shown as due
+# tomorrow (risk), per visa type
+DEFAULT_THRESHOLDS = {
+    'entry_visa_alert': 3,
+    'entry_visa_risk': 2,
+    'tourist_visa_alert': 8,
+    'tourist_visa_risk': 7,
+}
+
+# Rules and thresholds can be overridden by a JSON file at RULES_FILE (see
+# rules.json). It is compiled once and recompiled only when the file's
+# mtime or size changes; reload_rules() looks at most every
+# RULES_CHECK_SECONDS and keeps the last good config if an edit is invalid.
+# Rules in the file name their predicate from RULE_PREDICATES.
+RULES_FILE = os.environ.get("RULES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       "rules.json"))
+RULES_CHECK_SECONDS = float(os.environ.get("RULES_CHECK_SECONDS", 5))
+RULE_PREDICATES = {'needs_gcc_application': needs_gcc_application}
+config_log = logging.getLogger("preavailable.config")
+_rules_lock = threading.Lock()
+_rules_file = {'checked': None, 'stamp': None}
+
+def read_rules_file(path):
+    """Rule table and thresholds from a JSON config file, validated"""
+    with open(path) as f:
+        config = json.load(f)
+    rules = []
+    names = set()
+    for rule in config.get('rules', CATEGORY_RULES):
+        rule = dict(rule)
+        if rule.get('name') in names:
+            raise ValueError(f"Duplicate rule name {rule.get('name')!r}")
+        # A rule can only exclude categories assigned before it
+        for name in rule.get('exclude', []):
+            if name not in names:
+                raise ValueError(f"Rule {rule.get('name')!r} excludes {name!r}, which is not an earlier rule")
+        names.add(rule.get('name'))
+        if 'predicate' in rule and not callable(rule['predicate']):
+            if rule['predicate'] not in RULE_PREDICATES:
+                raise ValueError(f"Unknown predicate {rule['predicate']!r} in rule {rule.get('name')!r}")
+            rule['predicate'] = RULE_PREDICATES[rule['predicate']]
+        elif 'predicate' not in rule and not (rule.get('column') and rule.get('patterns')):
+            raise ValueError(f"Rule {rule.get('name')!r} needs a column and patterns, or a predicate")
+        rules.append(rule)
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for key, value in config.get('thresholds', {}).items():
+        if key not in DEFAULT_THRESHOLDS:
+            raise ValueError(f"Unknown threshold {key!r}")
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError(f"Threshold {key!r} must be a whole number of days")
+        if value < 0:
+            raise ValueError(f"Threshold {key!r} can't be negative")
+        thresholds[key] = value
+    for visa in ('entry_visa', 'tourist_visa'):
+        if thresholds[f'{visa}_risk'] > thresholds[f'{visa}_alert']:
+            raise ValueError(f"Threshold {visa}_risk can't be above {visa}_alert")
+    return rules, thresholds
+
+def install_rules(rules, thresholds):
+    """Compile a rule table and switch to it along with the thresholds"""
+    global _compiled_rules
+    compiled = compile_rules(rules)
+    compiled['fingerprint'] = rules_fingerprint(rules)
+    compiled['thresholds'] = dict(thresholds)
+    compiled['version'] = hashlib.sha1(
+        repr((compiled['fingerprint'], sorted(thresholds.items()))).encode()).hexdigest()[:16]
+    # A single swap, so concurrent requests see either the old or the new config
+    _compiled_rules = compiled
+
+def reload_rules(force=False):
+    """Recompile RULES_FILE if it changed since it was read; True when the config changed"""
+    now = time.monotonic()
+    checked = _rules_file['checked']
+    if not force and checked is not None and now - checked < RULES_CHECK_SECONDS:
+        return False
+    with _rules_lock:
+        _rules_file['checked'] = now
+        try:
+            stat = os.stat(RULES_FILE)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        if stamp == _rules_file['stamp'] and not force:
+            return False
+        _rules_file['stamp'] = stamp
+        version = _compiled_rules['version']
+        try:
+            if stamp is None:
+                install_rules(CATEGORY_RULES, DEFAULT_THRESHOLDS)
+            else:
+                install_rules(*read_rules_file(RULES_FILE))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error) as error:
+            config_log.warning("Keeping the current rules, %s is invalid: %s", RULES_FILE, error)
+            return False
+    if _compiled_rules['version'] == version:
+        return False
+    config_log.info("Loaded rules %s from %s", _compiled_rules['version'],
+                    RULES_FILE if stamp is not None else "the built-in defaults")
+    return True
+
+install_rules(CATEGORY_RULES, DEFAULT_THRESHOLDS)
+reload_rules(force=True)
+
+def rules_version():
+    """Fingerprint of the category rules in use"""
+    return _compiled_rules['fingerprint']
+
+def config_version():
+    """Fingerprint of the category rules and thresholds in use"""
+    return _compiled_rules['version']
+
+def visa_thresholds():
+    """Alert and risk thresholds in use, in days since landing"""
+    return dict(_compiled_rules['thresholds'])
+
+def _pattern_masks(series, column_rules):
+    """Pattern bitmask per row, evaluating the regexes once per distinct value"""
+    codes, uniques = pd.factorize(series)
+    unique_masks = np.zeros(len(uniques) + 1, dtype=np.int64)
+    for i, value in enumerate(uniques):
+        if not isinstance(value, str) or not column_rules['combined'].search(value):
+            continue
+        mask = 0
+        for bit, regex in enumerate(column_rules['regexes']):
+            if regex.search(value):
+                mask |= 1 << bit
+        unique_masks[i] = mask
+    # Missing values get code -1, which maps onto the trailing zero mask
+    return unique_masks[codes]
+
+def categorize(df, compiled=None):
+    """Return an integer bitmask per row of the categories it belongs to
+
+    Rules reading a column the frame lacks (a file uploaded only for
+    comparison) match no rows.
+    """
+    compiled = compiled or _compiled_rules
+    pattern_masks = {
+        column: (_pattern_masks(df[column], column_rules) if column in df.columns
+                 else np.zeros(len(df), dtype=np.int64))
+        for column, column_rules in compiled['columns'].items()
+    }
+
+    membership = np.zeros(len(df), dtype=np.int64)
+    for rule in compiled['rules']:
+        if rule['predicate'] is not None:
+            try:
+                match = np.asarray(rule['predicate'](df), dtype=bool)
+            except KeyError:
+                match = np.zeros(len(df), dtype=bool)
+        else:
+            masks = pattern_masks[rule['column']]
+            match = (masks & rule['required']) == rule['required']
+        if rule['exclude']:
+            match &= (membership & rule['exclude']) == 0
+        membership[match] |= rule['bit']
+    return membership
+
+def process_data(df):
+    """Process data into categories based on visa step and other conditions"""
+    return split_categories(df, categorize(df))
+
+def category_rows(membership):
+    """Row positions of each category from a row membership bitmask"""
+    rows = {rule['name']: np.flatnonzero(membership & rule['bit'])
+            for rule in _compiled_rules['rules']}
+
+    # Add remaining rows to "unmatched" category
+    rows[UNMATCHED_CATEGORY] = np.flatnonzero(membership == 0)
+
+    return rows
+
+def split_categories(df, membership):
+    """One frame per category from a row membership bitmask"""
+    return {name: df.iloc[rows] for name, rows in category_rows(membership).items()}
+
+def category_labels(membership):
+    """Comma-separated category names for each row of a membership bitmask"""
+    values, inverse = np.unique(membership, return_inverse=True)
+    labels = np.array([
+        ", ".join(rule['name'] for rule in _compiled_rules['rules'] if value & rule['bit'])
+        or UNMATCHED_CATEGORY
+        for value in values
+    ], dtype=object)
+    return labels[inverse.reshape(-1)]
+
+# Incremental processing. A new upload is matched to the previous snapshot by
+# Housemaid Id; rows whose values are unchanged keep their category bits and
+# only added or edited rows go through categorize(). The same alignment
+# gives the "changes since last upload" table.
+ID_COLUMN = 'Housemaid Id'
+
+def previous_upload(token):
+    """The most recently uploaded snapshot other than this one with the analytics columns, or None"""
+    for snapshot in list_snapshots():
+        if snapshot['token'] == token:
+            continue
+        entry = load_snapshot(snapshot['token'])
+        if entry is None:
+            return None
+        # Files uploaded only for comparison are not a previous export
+        if schema_report(entry['df'].columns, required_columns()) is None:
+            entry['token'] = snapshot['token']
+            return entry
+    return None
+
+def _row_hashes(df, columns):
+    """One 64-bit hash per row over the given columns"""
+    frame = df[columns].copy(deep=False)
+    for col in columns:
+        # Snapshots may round-trip timestamps at a different resolution
+        if pd.api.types.is_datetime64_any_dtype(frame[col]):
+            frame[col] = frame[col].astype('datetime64[ns]')
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+def align_uploads(previous, df):
+    """Position in the previous upload of each row, and whether it is unchanged
+
+    Returns None when the two uploads cannot be matched row by row (no
+    unique Housemaid Id, or a different set of columns).
+    """
+    old = previous['df']
+    if (ID_COLUMN not in df.columns or ID_COLUMN not in old.columns
+            or set(df.columns) != set(old.columns)):
+        return None
+    old_ids = pd.Index(old[ID_COLUMN])
+    new_ids = df[ID_COLUMN]
+    if not old_ids.is_unique or not new_ids.is_unique:
+        return None
+    
+    positions = old_ids.get_indexer(new_ids)
+    positions[new_ids.isna().to_numpy()] = -1
+    found = positions >= 0
+    columns = list(df.columns)
+    unchanged = found.copy()
+    unchanged[found] = (_row_hashes(df, columns)[found] ==
+                        _row_hashes(old, columns)[positions[found]])
+    return positions, unchanged
+
+def categorize_incremental(df, previous, alignment):
+    """Category bitmask for df, reusing the previous upload's bits for unchanged rows"""
+    if alignment is None or previous['membership'] is None:
+        return categorize(df)
+    positions, unchanged = alignment
+    membership = np.zeros(len(df), dtype=np.int64)
+    membership[unchanged] = previous['membership'][positions[unchanged]]
+    changed = np.flatnonzero(~unchanged)
+    if len(changed):
+        with timed('upload.categorize', rows=len(changed)):
+            membership[changed] = categorize(df.iloc[changed])
+    return membership
+
+def upload_changes(previous, entry, alignment):
+    """Rows added, removed or moved between categories or visa steps since the previous upload"""
+    columns = ['Housemaid Id', 'Housemaid Name', 'Change', 'Category Before', 'Category After',
+               'Visa Step Before', 'Visa Step After']
+    if alignment is None:
+        return pd.DataFrame(columns=columns)
+    positions, unchanged = alignment
+    df, old = entry['df'], previous['df']
+    new_labels = category_labels(get_membership(entry))
+    old_labels = category_labels(previous['membership'] if previous['membership'] is not None
+                                 else categorize(old))
+    
+    # Rows still present: keep those whose categories or visa step moved
+    kept = np.flatnonzero((positions >= 0) & ~unchanged)
+    before = positions[kept]
+    step_after = df['Current Visa Step'].astype(object).to_numpy()[kept]
+    step_before = old['Current Visa Step'].astype(object).to_numpy()[before]
+    same_step = (step_after == step_before) | (pd.isna(step_after) & pd.isna(step_before))
+    moved = (new_labels[kept] != old_labels[before]) | ~same_step
+    kept, before = kept[moved], before[moved]
+    
+    added = np.flatnonzero(positions < 0)
+    removed = np.setdiff1d(np.arange(len(old)), positions[positions >= 0])
+    
+    def side(frame, rows):
+        return (frame[ID_COLUMN].to_numpy()[rows],
+                frame['Housemaid Name'].astype(object).to_numpy()[rows],
+                frame['Current Visa Step'].astype(object).to_numpy()[rows])
+    
+    parts = []
+    ids, names, steps = side(df, added)
+    parts.append(pd.DataFrame({'Housemaid Id': ids, 'Housemaid Name': names, 'Change': 'Added',
+                               'Category Before': None, 'Category After': new_labels[added],
+                               'Visa Step Before': None, 'Visa Step After': steps}))
+    ids, names, steps = side(old, removed)
+    parts.append(pd.DataFrame({'Housemaid Id': ids, 'Housemaid Name': names, 'Change': 'Removed',
+                               'Category Before': old_labels[removed], 'Category After': None,
+                               'Visa Step Before': steps, 'Visa Step After': None}))
+    ids, names, steps = side(df, kept)
+    parts.append(pd.DataFrame({'Housemaid Id': ids, 'Housemaid Name': names, 'Change': 'Changed',
+                               'Category Before': old_labels[before], 'Category After': new_labels[kept],
+                               'Visa Step Before': old['Current Visa Step'].astype(object).to_numpy()[before],
+                               'Visa Step After': steps}))
+    changes = pd.concat(parts, ignore_index=True)[columns]
+    changes.attrs['previous'] = {'filename': previous['filename'], 'uploaded': previous.get('uploaded')}
+    return changes
+
+def live_type_labels(series):
+    """Map 'Live out type' values to Live In / Live Out / Unknown labels"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Label each distinct value once and broadcast through the codes
+        labels = np.append(live_type_labels(pd.Series(series.cat.categories)).to_numpy(), 'Unknown')
+        return pd.Series(labels[series.cat.codes.to_numpy()], index=series.index)
+    stripped = series.astype('string').str.strip()
+    labels = np.select(
+        [stripped.eq('CC').fillna(False).to_numpy(dtype=bool),
+         stripped.eq('CC (Live out)').fillna(False).to_numpy(dtype=bool)],
+        ['Live In', 'Live Out'],
+        default='Unknown'
+    )
+    return pd.Series(labels, index=series.index)
+
+def visa_table_frame(rows, threshold_labels=None):
+    """Columns shown in the visa alert and at-risk tables
+
+    The category bitmask, when rows carry one, is kept as a 'Categories'
+    column for cross-filtering; it is not displayed.
+    """
+    landed = rows['Landed In Dubai']
+    if pd.api.types.is_datetime64_any_dtype(landed):
+        landed = landed.dt.strftime('%Y-%m-%d')
+    table = pd.DataFrame({
+        'Housemaid Name': rows['Housemaid Name'],
+        'Nationality': rows['Nationality'].astype(object),
+        'Type of Visa': rows['Type of Visa'].astype(object),
+        'Landed In Dubai': landed,
+        'Days Since Landing': rows['Days Since Landing'].astype('Int64'),
+        'Live Type': live_type_labels(rows['Live out type']),
+        'Visa Step': rows['Current Visa Step'].astype(object),
+    })
+    if 'Days Until Breach' in rows:
+        table.insert(table.columns.get_loc('Days Since Landing') + 1, 'Days Until Breach',
+                     rows['Days Until Breach'].astype('Int64'))
+    if threshold_labels is not None:
+        table['Threshold'] = threshold_labels
+    if SNAPSHOT_MASK_COLUMN in rows:
+        table['Categories'] = rows[SNAPSHOT_MASK_COLUMN].to_numpy()
+    return table
+
+# Landing dates are parsed once per upload with an explicit format, and day
+# counts are taken against a single "now" in the office's timezone
+LOCAL_TIMEZONE = os.environ.get("LOCAL_TIMEZONE", "Asia/Dubai")
+LANDING_DATE_FORMAT = os.environ.get("LANDING_DATE_FORMAT", "ISO8601")
+
+def reference_now():
+    """Current wall-clock time in LOCAL_TIMEZONE as a naive timestamp"""
+    return pd.Timestamp.now(tz=LOCAL_TIMEZONE).tz_localize(None)
+
+def parse_landing_dates(values):
+    """Parse a landing date column, returning the dates and the failure count"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        dates = values.dt.tz_localize(None) if values.dt.tz is not None else values
+        return dates, 0
+    dates = pd.to_datetime(values, format=LANDING_DATE_FORMAT, errors='coerce')
+    present = values.notna() & values.astype('string').str.strip().ne('').fillna(False)
+    return dates, int((present & dates.isna()).sum())
+
+def days_since_landing(values, now=None):
+    """Whole days between each landing date and now, NaN where unknown"""
+    dates, failures = parse_landing_dates(values)
+    now = reference_now() if now is None else now
+    return (now - dates).dt.days.astype('float64'), failures
+
+def visa_type_masks(visa_type):
+    """Entry visa and tourist visa rows; a blank visa type counts as tourist"""
+    entry = visa_type.eq('Entry Visa').fillna(False).to_numpy(dtype=bool)
+    tourist = (visa_type.isin(['Tourist Visa', '']) | visa_type.isna()).to_numpy(dtype=bool)
+    return entry, tourist
+
+def visa_deadline_masks(visa_type, days, entry_alert, entry_risk, tourist_alert, tourist_risk):
+    """Alert and at-risk masks, and days until each row passes its alert threshold
+
+    A row is at risk from its visa type's risk threshold until it turns
+    into an alert, so it shows up on every upload in between rather than
+    on one exact day. Days until breach is NaN where there is no landing
+    date or threshold, and zero or less for rows already alerted.
+    """
+    entry, tourist = visa_type_masks(visa_type)
+    alert = np.select([entry, tourist], [entry_alert, tourist_alert], default=np.nan)
+    risk = np.select([entry, tourist], [entry_risk, tourist_risk], default=np.nan)
+    days = days.to_numpy(dtype='float64')
+    until_breach = alert + 1 - days
+    alerts = until_breach <= 0
+    at_risk = (days >= risk) & ~alerts
+    return alerts, at_risk, until_breach
+
+# The risk forecast counts, for each of the next FORECAST_DAYS days, the
+# rows that will pass their alert threshold on that day
+FORECAST_DAYS = 14
+FORECAST_BUCKETS = [(1, 1, "Tomorrow"), (2, 3, "In 2-3 days"), (4, 7, "In 4-7 days"),
+                    (8, FORECAST_DAYS, f"In 8-{FORECAST_DAYS} days")]
+
+def breach_forecast(summary):
+    """Rows breaching on each of the next FORECAST_DAYS days, by visa type
+
+    Computed from the analytics summary, with the thresholds and date it
+    was built with, so it can be redrawn for any cross-filter.
+    """
+    thresholds, today = summary.attrs['thresholds'], pd.Timestamp(summary.attrs['as_of'])
+    _, _, until_breach = visa_deadline_masks(
+        summary['Type of Visa'], summary['Days Since Landing'],
+        thresholds['entry_visa_alert'], thresholds['entry_visa_risk'],
+        thresholds['tourist_visa_alert'], thresholds['tourist_visa_risk']
+    )
+    entry, tourist = visa_type_masks(summary['Type of Visa'])
+    upcoming = (until_breach >= 1) & (until_breach <= FORECAST_DAYS)
+    in_days = np.where(upcoming, until_breach, 0).astype(np.int64)
+    rows = summary['Rows'].to_numpy()
+    offsets = np.arange(1, FORECAST_DAYS + 1)
+    counts = {
+        label: np.bincount(in_days[upcoming & mask], weights=rows[upcoming & mask],
+                           minlength=FORECAST_DAYS + 1)[1:].astype(np.int64)
+        for label, mask in (('Entry Visa', entry), ('Tourist Visa', tourist))
+    }
+    forecast = pd.DataFrame({
+        'Date': (today + pd.to_timedelta(offsets, unit='D')).strftime('%Y-%m-%d'),
+        'In Days': offsets,
+        **counts,
+    })
+    forecast['Total'] = forecast['Entry Visa'] + forecast['Tourist Visa']
+    return forecast
+
+def forecast_buckets(forecast):
+    """Breaches tomorrow, in 2-3, 4-7 and 8-14 days from a breach forecast"""
+    return {label: int(forecast.loc[forecast['In Days'].between(low, high), 'Total'].sum())
+            for low, high, label in FORECAST_BUCKETS}
+
+def combine_summaries(summaries):
+    """One analytics summary from the summaries of separate chunks of an upload"""
+    frame = pd.concat(summaries, ignore_index=True)
+    keys = [col for col in frame.columns if col != 'Rows']
+    summary = (frame.groupby(keys, observed=True, sort=False, dropna=False)['Rows'].sum()
+                    .reset_index())
+    summary.attrs.update(summaries[0].attrs)
+    return summary
+
+def analytics_summary(df, membership, days):
+    """Row counts per nationality, visa type, live type, category bitmask and landing day
+
+    One groupby over the upload; the counters, the chart, the category
+    counts and the breach forecast are all small sums over this frame, for
+    the whole upload or any cross-filter of it.
+    """
+    keys = pd.DataFrame({
+        'Nationality': df['Nationality'],
+        'Type of Visa': df['Type of Visa'],
+        'Live Type': live_type_labels(df['Live out type']),
+        'Categories': membership,
+        'Landed In Dubai': parse_landing_dates(df['Landed In Dubai'])[0].dt.normalize(),
+        'Days Since Landing': days,
+    })
+    return (keys.groupby(list(keys.columns), observed=True, sort=False, dropna=False)
+                .size().rename('Rows').reset_index())
+
+# Analytics cross-filters: each is a list of accepted values, plus an
+# optional landing date range given as 'start' and 'end' (YYYY-MM-DD). They
+# apply to the analytics summary and to the alert tables alike.
+CROSS_FILTERS = ['Nationality', 'Type of Visa', 'Live Type', 'Category']
+
+def cross_filter_mask(frame, filters):
+    """Boolean mask of summary or alert table rows matching the cross-filters"""
+    mask = np.ones(len(frame), dtype=bool)
+    if not filters:
+        return mask
+    for col in CROSS_FILTERS[:3]:
+        if filters.get(col):
+            mask &= frame[col].isin(filters[col]).to_numpy(dtype=bool)
+    if filters.get('Category'):
+        names = set(filters['Category'])
+        bits = sum(rule['bit'] for rule in _compiled_rules['rules'] if rule['name'] in names)
+        categories = frame['Categories'].to_numpy()
+        selected = (categories & bits) != 0
+        if UNMATCHED_CATEGORY in names:
+            selected |= categories == 0
+        mask &= selected
+    if filters.get('start') or filters.get('end'):
+        landed = frame['Landed In Dubai']
+        if not pd.api.types.is_datetime64_any_dtype(landed):
+            landed = pd.to_datetime(landed, errors='coerce')
+        landed = landed.to_numpy()
+        if filters.get('start'):
+            mask &= landed >= np.datetime64(filters['start'][:10])
+        if filters.get('end'):
+            mask &= landed <= np.datetime64(filters['end'][:10])
+    return mask
+
+def summary_counts(summary):
+    """Total, Live In and Live Out row counts from the analytics summary"""
+    live_rows = summary.groupby('Live Type', observed=True)['Rows'].sum()
+    return {
+        'total_count': int(summary['Rows'].sum()),
+        'live_in_count': int(live_rows.get('Live In', 0)),
+        'live_out_count': int(live_rows.get('Live Out', 0)),
+    }
+
+# Groupings offered for the distribution chart
+BREAKDOWNS = {
+    'Nationality': "Nationality Distribution",
+    'Type of Visa': "Visa Type Distribution",
+    'Category': "Category Distribution",
+}
+
+def summary_breakdown(summary, by='Nationality'):
+    """Live In / Live Out counts per nationality, visa type or category"""
+    if by == 'Category':
+        summary = pd.concat(
+            [summary[(summary['Categories'] & rule['bit']) != 0].assign(Category=rule['name'])
+             for rule in _compiled_rules['rules']] +
+            [summary[summary['Categories'] == 0].assign(Category=UNMATCHED_CATEGORY)],
+            ignore_index=True
+        )
+    order = summary[by].dropna().unique()
+    live = summary[summary['Live Type'].isin(['Live In', 'Live Out'])]
+    table = (live.groupby([by, 'Live Type'], observed=True, sort=False)['Rows'].sum()
+                 .unstack(fill_value=0)
+                 .reindex(index=order, columns=['Live In', 'Live Out'], fill_value=0))
+    table = table[table.sum(axis=1) > 0]
+    table.index = table.index.astype(object)
+    return table.rename_axis(by).reset_index()
+
+def category_counts(summary):
+    """Number of rows in each category from the analytics summary"""
+    counts = {rule['name']: int(summary.loc[(summary['Categories'] & rule['bit']) != 0, 'Rows'].sum())
+              for rule in _compiled_rules['rules']}
+    counts[UNMATCHED_CATEGORY] = int(summary.loc[summary['Categories'] == 0, 'Rows'].sum())
+    return counts
+
+def compute_analytics(df, membership, now=None):
+    """Counts, distribution summary and alert tables for an upload"""
+    config = _compiled_rules
+    thresholds = config['thresholds']
+    
+    # Process visa alerts and at-risk cases
+    now = reference_now() if now is None else now
+    days, date_failures = days_since_landing(df['Landed In Dubai'], now)
+    date_failures += df.attrs.get('date_parse_failures', 0)
+    df = df.assign(**{'Days Since Landing': days, SNAPSHOT_MASK_COLUMN: membership})
+    
+    # Calculate counts
+    summary = analytics_summary(df, membership, days)
+    as_of = now.normalize().strftime('%Y-%m-%d')
+    summary.attrs.update(thresholds=dict(thresholds), as_of=as_of)
+    
+    # Exceeded threshold (alerts), cases nearing it (at risk) and days left before each breach
+    alert_mask, at_risk_mask, until_breach = visa_deadline_masks(
+        df['Type of Visa'], df['Days Since Landing'],
+        thresholds['entry_visa_alert'], thresholds['entry_visa_risk'],
+        thresholds['tourist_visa_alert'], thresholds['tourist_visa_risk']
+    )
+    visa_alerts = df[alert_mask].sort_values('Days Since Landing', ascending=False)
+    at_risk = (df[at_risk_mask].assign(**{'Days Until Breach': until_breach[at_risk_mask]})
+                               .sort_values('Days Until Breach', kind='stable'))
+    
+    return {
+        'config': config['version'],
+        'as_of': as_of,
+        **summary_counts(summary),
+        'summary': summary,
+        'date_failures': date_failures,
+        'forecast': breach_forecast(summary),
+        'visa_alerts': visa_table_frame(visa_alerts),
+        'at_risk': visa_table_frame(
+            at_risk,
+            threshold_labels=np.where(at_risk['Type of Visa'].eq('Entry Visa').fillna(False),
+                                      f"{thresholds['entry_visa_alert']} days",
+                                      f"{thresholds['tourist_visa_alert']} days")
+        ),
+    }
+
+# Exports hold one sheet (or file) per non-empty category. Categories are
+# row positions into the upload rather than copied frames, and rows are
+# converted EXPORT_CHUNK_ROWS at a time: sheets are written row by row in
+# xlsxwriter's constant_memory mode while a thread pool converts the next
+# chunks, so memory is bounded by the chunk size, not the category sizes.
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", 4))
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 10000))
+EXPORT_FORMATS = {
+    'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('_csv.zip', 'application/zip'),
+    'parquet': ('_parquet.zip', 'application/zip'),
+}
+
+def _row_tuples(frame):
+    """Row tuples of a frame with missing values as None, ready for write_row"""
+    columns = []
+    for col in frame.columns:
+        values = frame[col].astype(object)
+        columns.append(values.where(frame[col].notna(), None).tolist())
+    return list(zip(*columns))
+
+def _export_chunks(categories):
+    """(category, row positions) for each EXPORT_CHUNK_ROWS rows of every category"""
+    for name, rows in categories.items():
+        for start in range(0, len(rows), EXPORT_CHUNK_ROWS):
+            yield name, rows[start:start + EXPORT_CHUNK_ROWS]
+
+def open_excel_export(path):
+    """An xlsxwriter workbook in constant_memory mode and its header format"""
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True,
+                                          'default_date_format': 'yyyy-mm-dd'})
+    return workbook, workbook.add_format({'bold': True})
+
+def write_excel_export(df, categories, path):
+    """Write one sheet per non-empty category of df with constant memory"""
+    workbook, header_format = open_excel_export(path)
+    header = [str(col) for col in df.columns]
+    chunks = _export_chunks(categories)
+    sheet_name = worksheet = None
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as pool:
+        # Only EXPORT_WORKERS chunks are prepared ahead of the writer
+        pending = deque((name, pool.submit(_row_tuples, df.iloc[rows]))
+                        for name, rows in itertools.islice(chunks, EXPORT_WORKERS))
+        while pending:
+            name, rows = pending.popleft()
+            upcoming = next(chunks, None)
+            if upcoming is not None:
+                pending.append((upcoming[0], pool.submit(_row_tuples, df.iloc[upcoming[1]])))
+            if name != sheet_name:
+                sheet_name, row_number = name, 1
+                worksheet = workbook.add_worksheet(name[:31])
+                worksheet.write_row(0, 0, header, header_format)
+            for row in rows.result():
+                worksheet.write_row(row_number, 0, row)
+                row_number += 1
+    workbook.close()
+
+def write_zip_export(df, categories, path, fmt):
+    """Write one CSV or Parquet file per non-empty category of df into a zip"""
+    schema = pa.Schema.from_pandas(df, preserve_index=False) if fmt == 'parquet' else None
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, rows in categories.items():
+            if not len(rows):
+                continue
+            if fmt == 'csv':
+                with archive.open(f"{name}.csv", 'w') as member:
+                    text = io.TextIOWrapper(member, encoding='utf-8', newline='')
+                    for start in range(0, len(rows), EXPORT_CHUNK_ROWS):
+                        df.iloc[rows[start:start + EXPORT_CHUNK_ROWS]].to_csv(
+                            text, header=start == 0, index=False)
+                    text.flush()
+                    text.detach()
+            else:
+                import pyarrow.parquet as pq
+                with archive.open(f"{name}.parquet", 'w') as member:
+                    with pq.ParquetWriter(member, schema) as writer:
+                        for start in range(0, len(rows), EXPORT_CHUNK_ROWS):
+                            writer.write_table(pa.Table.from_pandas(
+                                df.iloc[rows[start:start + EXPORT_CHUNK_ROWS]],
+                                schema=schema, preserve_index=False))
+
+@contextmanager
+def category_writer(path, fmt):
+    """append(category, frame) for an xlsx or CSV zip export written a chunk at a time
+
+    Workbook sheets are added in the order their categories first appear;
+    CSVs are collected in a scratch directory and zipped in category order.
+    """
+    if fmt == 'xlsx':
+        workbook, header_format = open_excel_export(path)
+        sheets = {}
+        def append(name, frame):
+            if name not in sheets:
+                sheets[name] = [workbook.add_worksheet(name[:31]), 1]
+                sheets[name][0].write_row(0, 0, [str(col) for col in frame.columns], header_format)
+            worksheet, row_number = sheets[name]
+            for row in _row_tuples(frame):
+                worksheet.write_row(row_number, 0, row)
+                row_number += 1
+            sheets[name][1] = row_number
+        try:
+            yield append
+        finally:
+            workbook.close()
+        return
+
+    scratch = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    files = {}
+    def append(name, frame):
+        first = name not in files
+        if first:
+            files[name] = os.path.join(scratch, f"{len(files)}.csv")
+        frame.to_csv(files[name], mode='w' if first else 'a', header=first, index=False)
+    try:
+        yield append
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name in [rule['name'] for rule in _compiled_rules['rules']] + [UNMATCHED_CATEGORY]:
+                if name in files:
+                    archive.write(files[name], f"{name}.csv")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def normalize_names(series):
+    """Join key for names: trimmed, single-spaced and case-folded"""
+    return (series.astype('string')
+                  .str.strip()
+                  .str.replace(r'\s+', ' ', regex=True)
+                  .str.casefold())
+
+# Fuzzy name matching: names are folded to ASCII, blocked on phonetic token
+# keys so only plausible pairs are scored, then scored with a vectorized
+# character-bigram Dice coefficient.
+FUZZY_THRESHOLD = 0.85
+FUZZY_MAX_BLOCK_PAIRS = 20000
+
+_TRANSLITERATIONS = [
+    ('ph', 'f'), ('kh', 'k'), ('gh', 'g'), ('th', 't'), ('ck', 'k'),
+    ('q', 'k'), ('c', 'k'), ('z', 's'), ('y', 'i'), ('w', 'u'),
+]
+
+_NAME_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+def fold_name(name):
+    """ASCII-fold, lowercase and sort the tokens of a name"""
+    name = unicodedata.normalize('NFKD', str(name))
+    name = name.encode('ascii', 'ignore').decode('ascii').lower()
+    return ' '.join(sorted(_NAME_TOKEN_RE.findall(name)))
+
+_VOWELS_RE = re.compile(r'[aeiouh]')
+_REPEATS_RE = re.compile(r'(.)\1+')
+
+@lru_cache(maxsize=65536)
+def phonetic_key(token):
+    """Coarse sound-alike key: first letter plus the consonant skeleton"""
+    for src, dst in _TRANSLITERATIONS:
+        token = token.replace(src, dst)
+    if not token:
+        return token
+    return _REPEATS_RE.sub(r'\1', token[0] + _VOWELS_RE.sub('', token[1:]))
+
+# Bigram sets are bitsets over the padded alphabet of folded names, so the
+# shared bigrams of a pair are a popcount of the AND of two rows
+_BIGRAM_ALPHABET = ' abcdefghijklmnopqrstuvwxyz0123456789'
+_BIGRAM_CODES = np.zeros(256, dtype=np.int64)
+_BIGRAM_CODES[np.frombuffer(_BIGRAM_ALPHABET.encode(), dtype=np.uint8)] = np.arange(len(_BIGRAM_ALPHABET))
+_BIGRAM_WORDS = -(-len(_BIGRAM_ALPHABET) ** 2 // 64)
+_BYTE_BITS = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+FUZZY_CHUNK_PAIRS = 65536
+
+def _popcount(words):
+    """Number of set bits in each row of a uint64 array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _BYTE_BITS[words.view(np.uint8)].sum(axis=-1)
+
+def _bigram_sets(folded):
+    """Bitsets of the distinct character bigrams of each name, and their sizes"""
+    bits = np.zeros((len(folded), _BIGRAM_WORDS), dtype=np.uint64)
+    if len(folded) == 0:
+        return bits, np.zeros(0, dtype=np.int64)
+    padded = [f' {name} ' for name in folded]
+    lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+    codes = _BIGRAM_CODES[np.frombuffer(''.join(padded).encode('ascii'), dtype=np.uint8)]
+    # A bigram starts at every character but the last one of each name
+    starts = np.ones(len(codes), dtype=bool)
+    starts[np.cumsum(lengths) - 1] = False
+    starts = np.flatnonzero(starts)
+    ids = codes[starts] * len(_BIGRAM_ALPHABET) + codes[starts + 1]
+    rows = np.repeat(np.arange(len(folded)), lengths - 1)
+    np.bitwise_or.at(bits, (rows, ids >> 6), np.left_shift(np.uint64(1), (ids & 63).astype(np.uint64)))
+    return bits, _popcount(bits)
+
+def bigram_similarity(left_grams, right_grams, left_rows, right_rows):
+    """Dice similarity of bigram sets for each (left_row, right_row) pair"""
+    left_bits, left_sizes = left_grams
+    right_bits, right_sizes = right_grams
+    inter = np.empty(len(left_rows), dtype=np.int64)
+    for start in range(0, len(left_rows), FUZZY_CHUNK_PAIRS):
+        chunk = slice(start, start + FUZZY_CHUNK_PAIRS)
+        inter[chunk] = _popcount(left_bits[left_rows[chunk]] & right_bits[right_rows[chunk]])
+    total = left_sizes[left_rows] + right_sizes[right_rows]
+    return 2.0 * inter / np.maximum(total, 1)
+
+def _token_blocks(folded):
+    """Long-form table of (row, phonetic key) for every token of every name"""
+    tokens = pd.Series(folded, dtype=object).str.split().explode().dropna()
+    blocks = pd.DataFrame({'row': tokens.index.to_numpy(dtype=np.int64),
+                           'block': tokens.to_numpy(dtype=object)}).drop_duplicates()
+    unique = pd.unique(blocks['block'])
+    keys = dict(zip(unique, map(phonetic_key, unique)))
+    return blocks.assign(block=blocks['block'].map(keys).astype(object))
+
+def fuzzy_index(names):
+    """Folded names, token blocks and bigram sets of the names to match against"""
+    names = pd.unique(pd.Series(names, dtype=object).dropna())
+    folded = [fold_name(n) for n in names]
+    blocks = _token_blocks(folded)
+    return {'names': names, 'blocks': blocks, 'block_sizes': blocks['block'].value_counts(),
+            'grams': _bigram_sets(folded)}
+
+# Indexes of the second file of a comparison, kept per upload token so
+# comparing other files against the same upload skips rebuilding it
+FUZZY_INDEX_CACHE_SIZE = int(os.environ.get("FUZZY_INDEX_CACHE_SIZE", 4))
+_fuzzy_indexes = OrderedDict()
+
+def comparison_index(df, token=None):
+    """Fuzzy index of an upload's normalized names, cached by upload token"""
+    if token is not None and token in _fuzzy_indexes:
+        _fuzzy_indexes.move_to_end(token)
+        return _fuzzy_indexes[token]
+    index = fuzzy_index(normalize_names(df['Housemaid Name']).dropna().unique())
+    if token is not None:
+        _fuzzy_indexes[token] = index
+        while len(_fuzzy_indexes) > FUZZY_INDEX_CACHE_SIZE:
+            _fuzzy_indexes.popitem(last=False)
+    return index
+
+def fuzzy_name_map(left_names, right_names, threshold=FUZZY_THRESHOLD, right_index=None):
+    """Best match in right_names for each left name, as {left: (right, score)}
+
+    A prebuilt fuzzy_index() of right_names can be passed as right_index.
+    """
+    left_names = pd.unique(pd.Series(left_names, dtype=object).dropna())
+    if right_index is None:
+        right_index = fuzzy_index(right_names)
+    right_names = right_index['names']
+    if len(left_names) == 0 or len(right_names) == 0:
+        return {}
+
+    left_folded = [fold_name(n) for n in left_names]
+
+    # Candidate pairs share at least one phonetic token key. Very common keys
+    # carry little information and would blow up the pair count, so blocks
+    # larger than FUZZY_MAX_BLOCK_PAIRS are skipped.
+    left_blocks = _token_blocks(left_folded)
+    right_blocks = right_index['blocks']
+    sizes = left_blocks['block'].value_counts().mul(right_index['block_sizes'], fill_value=0)
+    usable = sizes.index[(sizes > 0) & (sizes <= FUZZY_MAX_BLOCK_PAIRS)]
+    pairs = (left_blocks[left_blocks['block'].isin(usable)]
+             .merge(right_blocks, on='block', suffixes=('_left', '_right'))
+             [['row_left', 'row_right']]
+             .drop_duplicates())
+    if pairs.empty:
+        return {}
+
+    # Bigram sets are built only for left names that have a candidate, and
+    # pairs whose set sizes alone rule out the threshold are not scored
+    left_rows = pairs['row_left'].to_numpy()
+    right_rows = pairs['row_right'].to_numpy()
+    candidates = np.unique(left_rows)
+    left_grams = _bigram_sets([left_folded[i] for i in candidates])
+    right_grams = right_index['grams']
+    packed = np.searchsorted(candidates, left_rows)
+    left_sizes, right_sizes = left_grams[1][packed], right_grams[1][right_rows]
+    possible = 2.0 * np.minimum(left_sizes, right_sizes) / np.maximum(left_sizes + right_sizes, 1) >= threshold
+    pairs = pairs[possible]
+    pairs = pairs.assign(score=bigram_similarity(left_grams, right_grams,
+                                                 packed[possible], right_rows[possible]))
+
+    best = (pairs[pairs['score'] >= threshold]
+            .sort_values('score', ascending=False, kind='stable')
+            .drop_duplicates('row_left'))
+    return {
+        left_names[l]: (right_names[r], round(float(s), 3))
+        for l, r, s in zip(best['row_left'], best['row_right'], best['score'])
+    }
+
+def _comparison_side(df, suffix):
+    """Reduce a file to the columns the comparison needs, keyed by normalized name"""
+    side = pd.DataFrame({
+        'key': normalize_names(df['Housemaid Name']).to_numpy(),
+        'step': df['Current Visa Step'].to_numpy(),
+        f'Name{suffix}': df['Housemaid Name'].to_numpy(),
+        f'Live Type{suffix}': live_type_labels(df['Live out type']).to_numpy(),
+        f'ID{suffix}': df['Housemaid Id'].astype(object).to_numpy() if 'Housemaid Id' in df.columns else None,
+    })
+    side['pos'] = np.arange(len(side))
+    return side[side['key'].notna()].copy()
+
+def compare_frames(df1, df2, mode='matches', fuzzy=False, threshold=FUZZY_THRESHOLD, right_index=None):
+    """Compare two exports with one hash join on (normalized name, visa step)
+
+    For fuzzy matching, right_index can be the comparison_index() of df2.
+    """
+    left = _comparison_side(df1, '_1')
+    right = _comparison_side(df2, '_2')
+
+    if fuzzy:
+        # Resolve names without an exact counterpart to their closest name in
+        # the second file, then join on the resolved key as usual
+        if right_index is None:
+            right_index = fuzzy_index(right['key'].unique())
+        # Object keys hash much faster than Arrow strings in isin()
+        exact = left['key'].astype(object).isin(right_index['names'])
+        unresolved = left.loc[~exact, 'key'].unique()
+        resolved = fuzzy_name_map(unresolved, None, threshold, right_index)
+        scores = left['key'].map({k: score for k, (_, score) in resolved.items()})
+        left['Match Score'] = scores.mask(exact, 1.0)
+        left['key'] = left['key'].map({k: match for k, (match, _) in resolved.items()}).fillna(left['key'])
+
+    # A missing step never matches, and only the first row of the second file
+    # is used for each name and step
+    right_steps = right[right['step'].notna()].drop_duplicates(['key', 'step'])
+    merged = left.merge(right_steps.drop(columns='pos'), on=['key', 'step'],
+                        how='outer', indicator=True, sort=False)
+
+    has_id_1 = 'Housemaid Id' in df1.columns
+    has_id_2 = 'Housemaid Id' in df2.columns
+
+    if mode == 'matches':
+        rows = merged[merged['_merge'] == 'both'].sort_values('pos')
+        out = pd.DataFrame({
+            'Name': rows['Name_1'],
+            'Current Visa Step': rows['step'],
+            'File 1 ID': rows['ID_1'],
+            'File 2 ID': rows['ID_2'],
+            'Live Type (File 1)': rows['Live Type_1'],
+            'Live Type (File 2)': rows['Live Type_2'],
+        })
+        if fuzzy:
+            out['Match Score'] = rows['Match Score']
+    elif mode == 'only_file_1':
+        rows = merged[(merged['_merge'] == 'left_only') & ~merged['key'].isin(right['key'])]
+        rows = rows.sort_values('pos')
+        out = pd.DataFrame({
+            'Name': rows['Name_1'],
+            'File 1 ID': rows['ID_1'],
+            'Current Visa Step': rows['step'],
+            'Live Type (File 1)': rows['Live Type_1'],
+        })
+        has_id_2 = False
+    elif mode == 'only_file_2':
+        rows = right[~right['key'].isin(left['key'])]
+        out = pd.DataFrame({
+            'Name': rows['Name_2'],
+            'File 2 ID': rows['ID_2'],
+            'Current Visa Step': rows['step'],
+            'Live Type (File 2)': rows['Live Type_2'],
+        })
+        has_id_1 = False
+    elif mode == 'step_changed':
+        rows = merged[(merged['_merge'] == 'left_only') & merged['key'].isin(right['key'])]
+        rows = rows.sort_values('pos')
+        # The step each name has in the second file (first occurrence)
+        first_in_2 = right.drop_duplicates('key').set_index('key')
+        other = first_in_2.reindex(rows['key'])
+        out = pd.DataFrame({
+            'Name': rows['Name_1'].to_numpy(),
+            'File 1 ID': rows['ID_1'].to_numpy(),
+            'File 2 ID': other['ID_2'].to_numpy(),
+            'Visa Step (File 1)': rows['step'].to_numpy(),
+            'Visa Step (File 2)': other['step'].to_numpy(),
+            'Live Type (File 1)': rows['Live Type_1'].to_numpy(),
+            'Live Type (File 2)': other['Live Type_2'].to_numpy(),
+        })
+        if fuzzy:
+            out['Match Score'] = rows['Match Score'].to_numpy()
+        out = out[out['Visa Step (File 1)'].notna() | out['Visa Step (File 2)'].notna()]
+    else:
+        raise ValueError(f"Unknown comparison mode: {mode}")
+
+    if not has_id_1:
+        out = out.drop(columns='File 1 ID', errors='ignore')
+    if not has_id_2:
+        out = out.drop(columns='File 2 ID', errors='ignore')
+
+    return out
+
+# History: each export ingested for trend analysis is reduced to one small
+# Arrow file per export date in HISTORY_DIR, holding the visa step and
+# category bitmask of every Housemaid Id on that day. Files are named by
+# date, so a window query memory-maps only the days it covers. The category
+# names are stored with each file and bits are remapped on read, so days
+# categorized under an older rule table still count under the current one.
+HISTORY_DIR = os.environ.get("HISTORY_DIR", os.path.join(tempfile.gettempdir(), "preavailable-history"))
+HISTORY_DAYS = int(os.environ.get("HISTORY_DAYS", 90))
+HISTORY_MAX_DAYS = int(os.environ.get("HISTORY_MAX_DAYS", 730))
+HISTORY_COLUMNS = ['Date', ID_COLUMN, 'Current Visa Step', 'Categories']
+
+def export_date(filename, fallback=None):
+    """Date of an export from a YYYY-MM-DD or YYYYMMDD in its name, else fallback"""
+    match = re.search(r'(20\d{2})-?(\d{2})-?(\d{2})', filename or '')
+    if match:
+        try:
+            return pd.Timestamp(*map(int, match.groups())).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    return fallback
+
+def history_path(date):
+    """File in the history store holding one export date"""
+    return os.path.join(HISTORY_DIR, f"{date}.arrow")
+
+def history_dates():
+    """Export dates in the history store, oldest first"""
+    if not os.path.isdir(HISTORY_DIR):
+        return []
+    return sorted(name[:-len('.arrow')] for name in os.listdir(HISTORY_DIR)
+                  if re.fullmatch(r'\d{4}-\d{2}-\d{2}\.arrow', name))
+
+def save_history(date, df, membership, filename):
+    """Write (or replace) the history store entry for one export date"""
+    if feather is None:
+        raise RuntimeError("History needs pyarrow installed")
+    ids = df[ID_COLUMN]
+    if pd.api.types.is_float_dtype(ids) and (ids.dropna() % 1 == 0).all():
+        # Integer Ids read as floats because of blanks
+        ids = ids.astype('Int64')
+    # One row per Id and day; a repeated Id keeps its first row
+    has_id = (ids.notna() & ~ids.duplicated()).to_numpy()
+    frame = pd.DataFrame({
+        ID_COLUMN: ids.astype('string')[has_id].to_numpy(),
+        'Current Visa Step': pd.Categorical(df['Current Visa Step'].astype(object)[has_id]),
+        'Categories': membership[has_id],
+    })
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    meta = {'filename': filename, 'categories': [rule['name'] for rule in _compiled_rules['rules']]}
+    table = table.replace_schema_metadata({b'preavailable': json.dumps(meta).encode()})
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=HISTORY_DIR, suffix='.part')
+    os.close(fd)
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, history_path(date))
+    cutoff = (pd.Timestamp(date) - pd.Timedelta(days=HISTORY_MAX_DAYS)).strftime('%Y-%m-%d')
+    for old in history_dates():
+        if old < cutoff:
+            try:
+                os.remove(history_path(old))
+            except OSError:
+                pass
+
+def ingest_history_file(path, filename, date):
+    """Categorize one export and file it in the history store under date"""
+    with timed('history.ingest') as sample:
+        df, error = read_workbook(path, filename)
+        if error:
+            return {'file': filename, 'error': error}
+        if ID_COLUMN not in df.columns or 'Current Visa Step' not in df.columns:
+            return {'file': filename, 'error': f"{ID_COLUMN} and Current Visa Step columns are required"}
+        sample['rows'] = len(df)
+        save_history(date, df, categorize(df), filename)
+    return {'file': filename, 'date': date, 'rows': len(df)}
+
+def ingest_history(sources, workers=None, progress=None):
+    """Ingest (path, filename, date) exports in parallel; progress(done, total) after each"""
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(ingest_history_file, *source): source for source in sources}
+        try:
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append({'file': futures[future][1], 'error': str(e)})
+                if progress is not None:
+                    progress(len(results), len(sources))
+        except BaseException:
+            # Stop queued files; the ones already running finish first
+            pool.shutdown(cancel_futures=True)
+            raise
+    return sorted(results, key=lambda result: result.get('date') or '')
+
+def _remap_categories(masks, names):
+    """Translate category bits written under another rule table to the current one"""
+    current = {rule['name']: rule['bit'] for rule in _compiled_rules['rules']}
+    if names == list(current):
+        return masks
+    remapped = np.zeros_like(masks)
+    for i, name in enumerate(names):
+        if name in current:
+            remapped[(masks >> i) & 1 == 1] |= current[name]
+    return remapped
+
+def load_history(days=HISTORY_DAYS):
+    """Timeline rows of the last `days` days of the history store"""
+    dates = history_dates()
+    if days and dates:
+        start = (pd.Timestamp(dates[-1]) - pd.Timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        dates = [date for date in dates if date >= start]
+    if not dates:
+        return pd.DataFrame(columns=HISTORY_COLUMNS)
+    tables = []
+    with timed('history.load') as sample:
+        for date in dates:
+            table = feather.read_table(history_path(date), memory_map=True)
+            meta = json.loads(table.schema.metadata[b'preavailable'])
+            masks = _remap_categories(table['Categories'].to_numpy(), meta['categories'])
+            table = table.set_column(table.schema.get_field_index('Categories'), 'Categories',
+                                     pa.array(masks))
+            tables.append(table.append_column('Date', pa.array(
+                np.full(table.num_rows, np.datetime64(date, 'ns')))))
+        history = pa.concat_tables(tables).unify_dictionaries().to_pandas()
+        sample['rows'] = len(history)
+    return history[HISTORY_COLUMNS]
+
+def step_runs(history):
+    """Each Housemaid Id's stretches in one visa step, with the days spent in it
+
+    A run ends when the next export shows the same Id in another step. Runs
+    still going at the Id's last export are marked open and measured up to
+    that export.
+    """
+    steps = history['Current Visa Step'].astype('category')
+    if not len(history):
+        return pd.DataFrame({ID_COLUMN: [], 'Step': steps, 'Start': history['Date'],
+                             'Days': np.array([], dtype=np.int64), 'Open': np.array([], dtype=bool)})
+    # Sort on integer codes rather than the Id strings
+    id_codes, id_values = pd.factorize(history[ID_COLUMN])
+    dates = history['Date'].to_numpy()
+    order = np.lexsort((dates, id_codes))
+    ids, dates = id_codes[order], dates[order]
+    step_codes = steps.cat.codes.to_numpy()[order]
+    
+    new_run = np.r_[True, (ids[1:] != ids[:-1]) | (step_codes[1:] != step_codes[:-1])]
+    starts = np.flatnonzero(new_run)
+    last = np.r_[starts[1:], len(ids)] - 1
+    closed = np.r_[ids[starts[1:]] == ids[starts[:-1]], False]
+    ends = np.where(closed, dates[np.minimum(last + 1, len(ids) - 1)], dates[last])
+    runs = pd.DataFrame({
+        ID_COLUMN: np.asarray(id_values)[ids[starts]],
+        'Step': pd.Categorical.from_codes(step_codes[starts], dtype=steps.dtype),
+        'Start': dates[starts],
+        'Days': (ends - dates[starts]) // np.timedelta64(1, 'D'),
+        'Open': ~closed,
+    })
+    return runs[runs['Step'].notna()]
+
+def dwell_distribution(runs):
+    """Completed runs per visa step and whole days spent in it"""
+    done = runs[~runs['Open']]
+    return (done.groupby(['Step', 'Days'], observed=True, sort=True).size()
+                .rename('Runs').reset_index())
+
+def bottleneck_steps(runs, history):
+    """Visa steps ranked by how long cases stay in them"""
+    latest = history['Date'].max()
+    waiting = history.loc[history['Date'] == latest, 'Current Visa Step'].value_counts()
+    done = runs[~runs['Open']].groupby('Step', observed=True)['Days']
+    still_open = runs[runs['Open']].groupby('Step', observed=True)['Days']
+    table = pd.DataFrame({
+        'Waiting Now': waiting,
+        'Exits': done.size(),
+        'Median Days': done.median(),
+        '90th Percentile Days': done.quantile(0.9),
+        'Longest Open Days': still_open.max(),
+    }).fillna(0)
+    table = table[(table['Waiting Now'] > 0) | (table['Exits'] > 0)]
+    table = table.astype({'Waiting Now': int, 'Exits': int, 'Longest Open Days': int})
+    return (table.sort_values(['Median Days', 'Waiting Now'], ascending=False)
+                 .rename_axis('Step').reset_index())
+
+def category_trend(history):
+    """Rows in each category on each export date"""
+    summary = history.groupby(['Date', 'Categories'], sort=True).size().rename('Rows').reset_index()
+    trend = {rule['name']: summary['Rows'].where((summary['Categories'] & rule['bit']) != 0, 0)
+             for rule in _compiled_rules['rules']}
+    trend[UNMATCHED_CATEGORY] = summary['Rows'].where(summary['Categories'] == 0, 0)
+    return pd.DataFrame(trend).groupby(summary['Date']).sum()
+
+def history_analytics(history):
+    """Dwell-time distribution, bottleneck steps and category counts over time"""
+    with timed('history.analytics', rows=len(history)):
+        runs = step_runs(history)
+        return {
+            'dates': history['Date'].nunique(),
+            'ids': runs[ID_COLUMN].nunique(),
+            'transitions': int((~runs['Open']).sum()),
+            'dwell': dwell_distribution(runs),
+            'bottlenecks': bottleneck_steps(runs, history),
+            'trend': category_trend(history),
+        }
+
+# Batch mode: every export in a directory is processed on its own core
+BATCH_EXTENSIONS = ('.xlsx', '.csv')
+ALERT_TABLES = ('visa_alerts', 'at_risk')
+
+def file_summary(filename, summary, date_failures, alert_counts, export):
+    """Batch summary of one processed export"""
+    counts = summary_counts(summary)
+    return {
+        'file': filename,
+        'rows': counts['total_count'],
+        'live_in': counts['live_in_count'],
+        'live_out': counts['live_out_count'],
+        'visa_alerts': alert_counts['visa_alerts'],
+        'at_risk': alert_counts['at_risk'],
+        'unreadable_dates': int(date_failures),
+        'breach_forecast': forecast_buckets(breach_forecast(summary)),
+        'categories': category_counts(summary),
+        'export': os.path.basename(export),
+    }
+
+def process_file(path, output_dir, fmt='xlsx', previous_path=None, history=False):
+    """Categorize one export and write its export, alert tables and summary"""
+    filename = os.path.basename(path)
+    stem = os.path.splitext(filename)[0]
+    with timed('batch.file') as sample:
+        df, error = read_workbook(path, filename, 'export')
+        if error:
+            return {'file': filename, 'error': error}
+        sample['rows'] = len(df)
+        entry = {'filename': filename, 'df': df, 'categories': None, 'membership': None}
+        analytics = compute_analytics(df, get_membership(entry))
+
+        categories = get_categories(entry)
+        suffix, _ = EXPORT_FORMATS[fmt]
+        export = os.path.join(output_dir, f"processed_{stem}{suffix}")
+        if fmt == 'xlsx':
+            write_excel_export(df, categories, export)
+        else:
+            write_zip_export(df, categories, export, fmt)
+        for name in ALERT_TABLES:
+            analytics[name].drop(columns='Categories').to_csv(
+                os.path.join(output_dir, f"{stem}_{name}.csv"), index=False)
+
+        summary = file_summary(filename, analytics['summary'], analytics['date_failures'],
+                               {name: len(analytics[name]) for name in ALERT_TABLES}, export)
+        if previous_path is not None:
+            previous_df, error = read_workbook(previous_path, os.path.basename(previous_path), 'export')
+            if error:
+                summary['changes_error'] = error
+            else:
+                previous = {'filename': os.path.basename(previous_path), 'df': previous_df,
+                            'categories': None, 'membership': None}
+                get_membership(previous)
+                changes = upload_changes(previous, entry, align_uploads(previous, df))
+                changes.to_csv(os.path.join(output_dir, f"{stem}_changes.csv"), index=False)
+                summary['changes'] = len(changes)
+        if history:
+            modified = pd.Timestamp(os.path.getmtime(path), unit='s', tz='UTC').tz_convert(LOCAL_TIMEZONE)
+            summary['history_date'] = export_date(filename, modified.strftime('%Y-%m-%d'))
+            save_history(summary['history_date'], df, get_membership(entry), filename)
+    return summary
+
+# Streaming mode (batch --stream) keeps memory bounded whatever the size of
+# an export: each chunk from read_workbook_chunks is categorized, checked
+# for visa alerts and appended to the export and alert tables before the
+# next one is read. Only the analytics summary is kept across chunks, and
+# it grows with the number of distinct values, not rows. Alert tables are
+# left in file order.
+STREAM_FORMATS = ('xlsx', 'csv')
+
+def analyze_chunks(chunks, append, now, stage):
+    """Categorize each chunk, append its categories to an export and yield (rows, analytics)"""
+    for chunk in chunks:
+        with timed(stage, rows=len(chunk)):
+            membership = categorize(chunk)
+            for name, positions in category_rows(membership).items():
+                if len(positions):
+                    append(name, chunk.iloc[positions])
+            analytics = compute_analytics(chunk, membership, now)
+        yield len(chunk), analytics
+
+def stream_file(path, output_dir, fmt='xlsx'):
+    """process_file in bounded memory, reading and writing one chunk at a time"""
+    filename = os.path.basename(path)
+    stem = os.path.splitext(filename)[0]
+    if fmt not in STREAM_FORMATS:
+        return {'file': filename, 'error': f"Streaming writes {' or '.join(STREAM_FORMATS)} exports only"}
+    with timed('batch.stream') as sample:
+        chunks, error = read_workbook_chunks(path, filename, use='export')
+        if error:
+            return {'file': filename, 'error': error}
+        suffix, _ = EXPORT_FORMATS[fmt]
+        export = os.path.join(output_dir, f"processed_{stem}{suffix}")
+        alert_paths = {name: os.path.join(output_dir, f"{stem}_{name}.csv") for name in ALERT_TABLES}
+        alert_counts = dict.fromkeys(ALERT_TABLES, 0)
+        now = reference_now()
+        summary, date_failures, rows = None, 0, 0
+        with category_writer(export, fmt) as append:
+            for chunk_rows, analytics in analyze_chunks(chunks, append, now, 'batch.chunk'):
+                for name in ALERT_TABLES:
+                    analytics[name].drop(columns='Categories').to_csv(
+                        alert_paths[name], mode='a' if rows else 'w', header=not rows, index=False)
+                    alert_counts[name] += len(analytics[name])
+                summary = (analytics['summary'] if summary is None
+                           else combine_summaries([summary, analytics['summary']]))
+                date_failures += analytics['date_failures']
+                rows += chunk_rows
+        sample['rows'] = rows
+        if summary is None:
+            # No data rows: nothing to bound, so write the empty outputs the usual way
+            return process_file(path, output_dir, fmt)
+        return file_summary(filename, summary, date_failures, alert_counts, export)
+
+def run_batch(input_dir, output_dir, workers=None, fmt='xlsx', compare_previous=False, history=False,
+              stream=False):
+    """Process every export in input_dir in parallel and return their summaries"""
+    if stream and (compare_previous or history):
+        raise ValueError("Streaming mode does not support comparisons or the history store")
+    paths = sorted(os.path.join(input_dir, name) for name in os.listdir(input_dir)
+                   if name.lower().endswith(BATCH_EXTENSIONS) and not name.startswith('~$'))
+    previous = [None] + paths[:-1] if compare_previous else [None] * len(paths)
+    os.makedirs(output_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if stream:
+            futures = [pool.submit(stream_file, path, output_dir, fmt) for path in paths]
+        else:
+            futures = [pool.submit(process_file, path, output_dir, fmt, before, history)
+                       for path, before in zip(paths, previous)]
+        summaries = []
+        for path, future in zip(paths, futures):
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                summaries.append({'file': os.path.basename(path), 'error': str(e)})
+    with open(os.path.join(output_dir, 'batch_summary.json'), 'w') as out:
+        json.dump(summaries, out, indent=2)
+    return summaries
+
+def main(argv=None):
+    """Command-line entry point for batch processing"""
+    global RULES_FILE
+    parser = argparse.ArgumentParser(
+        description="Process a directory of visa-step exports without the dashboard")
+    parser.add_argument('input_dir', help="directory of .xlsx or .csv exports")
+    parser.add_argument('output_dir', help="where processed files are written")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="parallel processes (default: one per core)")
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='xlsx',
+                        help="format of the categorized export")
+    parser.add_argument('--compare-previous', action='store_true',
+                        help="also list what changed since the previous file in name order")
+    parser.add_argument('--history', action='store_true',
+                        help="also file each export in the history store (HISTORY_DIR) under "
+                             "the date in its name")
+    parser.add_argument('--rules', help="rules and thresholds file (default: %s)" % RULES_FILE)
+    parser.add_argument('--stream', action='store_true',
+                        help="read and write each export STREAM_CHUNK_ROWS rows at a time so memory "
+                             "stays bounded (xlsx or csv; not with --compare-previous or --history)")
+    args = parser.parse_args(argv)
+    if args.stream and (args.compare_previous or args.history or args.format not in STREAM_FORMATS):
+        parser.error("--stream writes xlsx or csv exports and cannot be combined with "
+                     "--compare-previous or --history")
+
+    if args.rules:
+        # Batch workers are spawned and read RULES_FILE from the environment
+        RULES_FILE = os.environ['RULES_FILE'] = os.path.abspath(args.rules)
+        try:
+            install_rules(*read_rules_file(RULES_FILE))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, re.error) as error:
+            print(f"{args.rules}: {error}", file=sys.stderr)
+            return 2
+
+    summaries = run_batch(args.input_dir, args.output_dir, args.workers, args.format,
+                          args.compare_previous, args.history, args.stream)
+    failed = [summary for summary in summaries if 'error' in summary]
+    for summary in summaries:
+        if 'error' in summary:
+            print(f"{summary['file']}: {summary['error']}", file=sys.stderr)
+        else:
+            print(f"{summary['file']}: {summary['rows']:,} rows, {summary['visa_alerts']:,} visa alerts, "
+                  f"{summary['at_risk']:,} at risk")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())